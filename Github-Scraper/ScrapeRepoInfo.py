@@ -3,6 +3,9 @@ import json
 import time
 import math
 import pickle
+import sqlite3
+import asyncio
+import aiohttp
 import requests
 from tqdm import tqdm
 import yaml
@@ -14,31 +17,173 @@ with open('config.yaml', 'r') as config_file:
 # Extract credentials and settings from config
 USER = config['user']
 TOKEN = config['token']
-CHECKPOINT_FILE = config['checkpoint_file']
+# Optional list of extra tokens; each has its own rate-limit budget
+TOKENS = [TOKEN] + [token for token in (config.get('tokens') or []) if token != TOKEN]
+CHECKPOINT_FILE = config['checkpoint_file']  # Old pickled checkpoint, imported into CHECKPOINT_DB once
+CHECKPOINT_DB = config.get('checkpoint_db', 'repo_ckpt.sqlite')
 OUTPUT_FILE = os.path.join(config['output_dir'], config['csv_file'])
+PLAN_FILE = config.get('plan_file', 'size_plan.json')
 
-REMAINING_REQUESTS = 30
+CKPT_EVERY_REQUESTS = 30
+SECONDARY_LIMIT_WAIT = 60  # GitHub asks for at least a minute when a secondary limit has no Retry-After
+SEARCH_QUALIFIERS = 'stars:>100'
+SEARCH_RESULT_CAP = 1000  # The search API returns at most 1000 results per query
+MAX_SIZE = 100  # Upper end of the repository size range to cover
+MAX_REPOS = 10  # Stop after collecting this many repositories
+PER_PAGE = 100
+CONCURRENT_WINDOWS = 4  # Size windows downloaded at the same time
+CONCURRENT_REQUESTS = 8  # Search requests in flight across all windows
+
+# 'graphql' fetches up to 100 repositories per request with the extra GRAPHQL_FIELDS;
+# 'rest' uses the search API and only gets name, stars and language
+COLLECT_MODE = config.get('collect_mode', 'rest')
+GRAPHQL_URL = 'https://api.github.com/graphql'
+# Extra CSV columns: name -> (GraphQL selection on Repository, value from the node)
+GRAPHQL_FIELD_SPECS = {
+    'size_kb': ('diskUsage', lambda node: node['diskUsage']),
+    'license': ('licenseInfo { spdxId }', lambda node: (node['licenseInfo'] or {}).get('spdxId')),
+    'topics': ('repositoryTopics(first: 20) { nodes { topic { name } } }',
+               lambda node: ';'.join(topic['topic']['name'] for topic in node['repositoryTopics']['nodes'])),
+    'default_branch': ('defaultBranchRef { name }', lambda node: (node['defaultBranchRef'] or {}).get('name')),
+    'default_branch_commit': ('defaultBranchRef { target { oid } }', lambda node: ((node['defaultBranchRef'] or {}).get('target') or {}).get('oid')),
+    'pushed_at': ('pushedAt', lambda node: node['pushedAt']),
+}
+GRAPHQL_FIELDS = config.get('graphql_fields') or ['size_kb', 'license', 'default_branch_commit']
+
+class UnexpectedStatusError(Exception):
+    pass
+
+class CheckpointStore:
+    """Collected repositories and the scan cursor in SQLite (WAL mode).
+
+    save() only inserts repositories that are new since the last save, the name column
+    keeps them unique, and the cursor moves in the same transaction, so a crash mid-save
+    leaves the previous checkpoint intact.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS repos (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, repo TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS scan_cursor (id INTEGER PRIMARY KEY CHECK (id = 1), lower_bound INTEGER, upper_bound INTEGER)')
+
+    def load(self):
+        cursor = self.conn.execute('SELECT lower_bound, upper_bound FROM scan_cursor WHERE id = 1').fetchone()
+        if cursor is None:
+            return None
+        return cursor[0], cursor[1], self.repos()
+
+    def repos(self):
+        return [tuple(json.loads(repo)) for repo, in self.conn.execute('SELECT repo FROM repos ORDER BY seq')]
+
+    def save(self, repos, lower_bound, upper_bound):
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO repos (name, repo) VALUES (?, ?)', [(repo[0], json.dumps(repo)) for repo in repos])
+            self.conn.execute('INSERT OR REPLACE INTO scan_cursor (id, lower_bound, upper_bound) VALUES (1, ?, ?)', (lower_bound, upper_bound))
+
+def add_repos(repos):
+    for repo in repos:
+        if repo[0] not in repo_names:
+            repo_names.add(repo[0])
+            repo_list.append(repo)
 
 def save_ckpt(lower_bound: int, upper_bound: int):
-    global repo_list
-    repo_list = list(set(repo_list))  # remove duplicates
+    # Only repositories added since the previous save are written
+    global saved_count
     print(f"Saving checkpoint {lower_bound, upper_bound}...")
-    with open(CHECKPOINT_FILE, 'wb') as f:
-        pickle.dump((lower_bound, upper_bound, repo_list), f)
-
-def get_request(lower_bound: int, upper_bound: int, page: int = 1):
-    global REMAINING_REQUESTS, USER, TOKEN, repo_list
-    r = requests.get(
-        f'https://api.github.com/search/repositories?q=size:{lower_bound}..{upper_bound}+stars:>100&per_page=10&page={page}',
-        auth=(USER, TOKEN)
-    )
+    ckpt_store.save(repo_list[saved_count:], lower_bound, upper_bound)
+    saved_count = len(repo_list)
 
-    if r.status_code == 403:
-        print('API rate limit exceeded.')
-        save_ckpt(lower_bound, upper_bound)
-        print('Exiting program.')
-        exit()
-    elif r.status_code == 422:
+class TokenPool:
+    """Rotates requests across tokens using the rate-limit headers of every response.
+
+    Each token remembers X-RateLimit-Remaining and X-RateLimit-Reset, plus the time it is
+    blocked until after a Retry-After or secondary limit. acquire() returns the usable token
+    with the most requests left and only sleeps when every token is exhausted.
+    """
+
+    def __init__(self, tokens):
+        self.index = {token: number for number, token in enumerate(tokens, 1)}  # For log lines only
+        self.remaining = {token: None for token in tokens}  # None until the first response
+        self.reset_at = {token: 0.0 for token in tokens}
+        self.available_at = {token: 0.0 for token in tokens}
+
+    def usable_at(self, token):
+        # A block (Retry-After, secondary limit) always holds; an empty budget holds until reset
+        if self.remaining[token] == 0:
+            return max(self.available_at[token], self.reset_at[token])
+        return self.available_at[token]
+
+    def next_token(self):
+        # Returns (token, 0) or (None, seconds to wait). A handed-out token's budget is
+        # reserved right away so concurrent requests do not all pick the same last request.
+        now = time.time()
+        usable = [token for token in self.remaining if self.usable_at(token) <= now]
+        if not usable:
+            return None, min(self.usable_at(token) for token in self.remaining) - now + 1
+        for token in usable:
+            if self.remaining[token] == 0:
+                self.remaining[token] = None  # Past its reset, budget unknown until the next response
+        token = max(usable, key=lambda token: float('inf') if self.remaining[token] is None else self.remaining[token])
+        if self.remaining[token]:
+            self.remaining[token] -= 1
+        return token, 0
+
+    def acquire(self):
+        while True:
+            token, wait = self.next_token()
+            if token is not None:
+                return token
+            print(f"All {len(self.remaining)} tokens are rate limited, waiting {wait:.0f} seconds...")
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        while True:
+            token, wait = self.next_token()
+            if token is not None:
+                return token
+            print(f"All {len(self.remaining)} tokens are rate limited, waiting {wait:.0f} seconds...")
+            await asyncio.sleep(wait)
+
+    def update(self, token, status, headers, text):
+        # Returns True when the request was rejected by a rate limit and should be retried
+        if 'X-RateLimit-Remaining' in headers:
+            remaining, reset_at = int(headers['X-RateLimit-Remaining']), int(headers['X-RateLimit-Reset'])
+            if reset_at == self.reset_at[token] and self.remaining[token] is not None:
+                # Same window: responses arrive out of order, the lowest count is the newest
+                remaining = min(remaining, self.remaining[token])
+            self.remaining[token], self.reset_at[token] = remaining, reset_at
+        if status not in (403, 429):
+            return False
+        if 'Retry-After' in headers:
+            self.available_at[token] = time.time() + int(headers['Retry-After'])
+        elif self.remaining[token] != 0:
+            if status == 403 and 'rate limit' not in text.lower():
+                return False
+            self.available_at[token] = time.time() + SECONDARY_LIMIT_WAIT
+        print(f"Token {self.index[token]} rate limited until {time.strftime('%H:%M:%S', time.localtime(self.usable_at(token)))}")
+        return True
+
+token_pool = TokenPool(TOKENS)
+# GraphQL has its own rate limit, separate from search
+graphql_token_pool = TokenPool(TOKENS)
+requests_since_ckpt = 0
+
+def search_url(lower_bound: int, upper_bound: int, page: int, per_page: int):
+    return f'https://api.github.com/search/repositories?q=size:{lower_bound}..{upper_bound}+{SEARCH_QUALIFIERS}&per_page={per_page}&page={page}'
+
+def get_request(lower_bound: int, upper_bound: int, page: int = 1, per_page: int = PER_PAGE, checkpoint: bool = True):
+    # checkpoint=False for planning queries: their bounds are not a scan position
+    global requests_since_ckpt, USER, repo_list
+    while True:
+        token = token_pool.acquire()
+        r = requests.get(search_url(lower_bound, upper_bound, page, per_page), auth=(USER, token))
+        if not token_pool.update(token, r.status_code, r.headers, r.text):
+            break
+
+    if r.status_code == 422:
         return False
 
     try:
@@ -46,84 +191,228 @@ def get_request(lower_bound: int, upper_bound: int, page: int = 1):
     except:
         print(f'Unexpected status code. Status code returned is {r.status_code}')
         print(r.text)
-        save_ckpt(lower_bound, upper_bound)
+        if checkpoint:
+            save_ckpt(lower_bound, upper_bound)
         print("Exiting program.")
         exit()
     
-    REMAINING_REQUESTS -= 1
+    if not checkpoint:
+        return r
+
+    requests_since_ckpt += 1
 
-    if REMAINING_REQUESTS == 0:
-        print("Sleeping 60 seconds to stay under GitHub API rate limit...")
-        time.sleep(60)
+    if requests_since_ckpt == CKPT_EVERY_REQUESTS:
         save_ckpt(lower_bound, upper_bound)
-        REMAINING_REQUESTS = 30
+        requests_since_ckpt = 0
 
     return r
 
-def download_range(lower_bound, upper_bound):
+def count_range(lower_bound: int, upper_bound: int):
+    r = get_request(lower_bound, upper_bound, per_page=1, checkpoint=False)
+    if not r:
+        return 0
+    return r.json()['total_count']
+
+def split_range(lower_bound: int, upper_bound: int, n_results: int):
+    # Halve the window until every piece fits under the cap. Only the left half is queried;
+    # the size ranges are disjoint, so the right half gets the remainder of the count.
+    if n_results <= SEARCH_RESULT_CAP or lower_bound == upper_bound:
+        if n_results > SEARCH_RESULT_CAP:
+            print(f"Size {lower_bound} alone has {n_results} results, only the first {SEARCH_RESULT_CAP} are reachable")
+        return [(lower_bound, upper_bound, n_results)]
+    middle = (lower_bound + upper_bound) // 2
+    n_left = count_range(lower_bound, middle)
+    return split_range(lower_bound, middle, n_left) + split_range(middle + 1, upper_bound, max(0, n_results - n_left))
+
+def merge_ranges(windows):
+    # Join neighbouring windows while their combined count still fits under the cap,
+    # so sparse and empty windows cost no extra requests
+    merged = []
+    for lower_bound, upper_bound, n_results in windows:
+        if merged and merged[-1][2] + n_results <= SEARCH_RESULT_CAP:
+            merged[-1] = (merged[-1][0], upper_bound, merged[-1][2] + n_results)
+        else:
+            merged.append((lower_bound, upper_bound, n_results))
+    return merged
+
+def plan_size_ranges(lower_bound: int, upper_bound: int):
+    # The plan is saved so reruns start downloading without spending requests on counts
+    if os.path.exists(PLAN_FILE):
+        with open(PLAN_FILE, 'r') as f:
+            plan = json.load(f)
+        if plan['qualifiers'] == SEARCH_QUALIFIERS and plan['lower_bound'] == lower_bound and plan['upper_bound'] == upper_bound:
+            print(f"Loaded {len(plan['windows'])} size windows from {PLAN_FILE}")
+            return [tuple(window) for window in plan['windows']]
+
+    n_results = count_range(lower_bound, upper_bound)
+    windows = merge_ranges(split_range(lower_bound, upper_bound, n_results))
+    print(f"Planned {len(windows)} size windows for {n_results} repositories")
+    with open(PLAN_FILE + '.tmp', 'w') as f:
+        json.dump({'qualifiers': SEARCH_QUALIFIERS, 'lower_bound': lower_bound, 'upper_bound': upper_bound, 'windows': windows}, f)
+    os.replace(PLAN_FILE + '.tmp', PLAN_FILE)
+    return windows
+
+async def fetch_page(session, lower_bound, upper_bound, page, request_slots):
+    while True:
+        token = await token_pool.acquire_async()
+        async with request_slots:
+            async with session.get(search_url(lower_bound, upper_bound, page, PER_PAGE), auth=aiohttp.BasicAuth(USER, token)) as r:
+                status, headers, text = r.status, r.headers, await r.text()
+        if not token_pool.update(token, status, headers, text):
+            break
+
+    if status == 422:
+        return None
+    if status != 200:
+        print(text)
+        raise UnexpectedStatusError(f'Unexpected status code. Status code returned is {status}')
+    return json.loads(text)
+
+def graphql_query():
+    selections = ' '.join(GRAPHQL_FIELD_SPECS[field][0] for field in GRAPHQL_FIELDS)
+    return (
+        'query($q: String!, $after: String) { search(query: $q, type: REPOSITORY, first: 100, after: $after) {'
+        ' pageInfo { hasNextPage endCursor }'
+        f' nodes {{ ... on Repository {{ nameWithOwner stargazerCount primaryLanguage {{ name }} {selections} }} }} }} }}'
+    )
+
+async def fetch_graphql_page(session, lower_bound, upper_bound, after, request_slots):
+    payload = {'query': graphql_query(), 'variables': {'q': f'size:{lower_bound}..{upper_bound} {SEARCH_QUALIFIERS}', 'after': after}}
+    while True:
+        token = await graphql_token_pool.acquire_async()
+        async with request_slots:
+            async with session.post(GRAPHQL_URL, json=payload, headers={'Authorization': f'bearer {token}'}) as r:
+                status, headers, text = r.status, r.headers, await r.text()
+        body = json.loads(text) if status == 200 else {}
+        if any(error.get('type') == 'RATE_LIMITED' for error in body.get('errors') or []):
+            # GraphQL reports its primary limit as a 200 with an error
+            status, text = 429, 'rate limit'
+        if not graphql_token_pool.update(token, status, headers, text):
+            break
+
+    if status != 200 or body.get('errors'):
+        print(text)
+        raise UnexpectedStatusError(f'Unexpected GraphQL response. Status code returned is {status}')
+    return body['data']['search']
+
+async def download_range_graphql(session, lower_bound, upper_bound, request_slots):
+    # Cursor pagination: pages of one window are sequential, windows still run in parallel
+    repos = []
+    after = None
+    while True:
+        search = await fetch_graphql_page(session, lower_bound, upper_bound, after, request_slots)
+        for node in search['nodes']:
+            if not node:
+                continue
+            language = (node['primaryLanguage'] or {}).get('name')
+            extra = tuple(GRAPHQL_FIELD_SPECS[field][1](node) for field in GRAPHQL_FIELDS)
+            repos.append((node['nameWithOwner'], node['stargazerCount'], language) + extra)
+        if not search['pageInfo']['hasNextPage']:
+            return repos
+        after = search['pageInfo']['endCursor']
+
+async def download_range(session, lower_bound, upper_bound, request_slots):
+    if COLLECT_MODE == 'graphql':
+        return await download_range_graphql(session, lower_bound, upper_bound, request_slots)
+    # The plan only fixes window boundaries; the live total_count of page 1 sizes the rest,
+    # so windows that grew (or were planned empty) since planning are fully downloaded
+    first_page = await fetch_page(session, lower_bound, upper_bound, 1, request_slots)
+    if not first_page:
+        return []
+    n_results = first_page['total_count']
+    if n_results:
+        print(f"Downloading {n_results} repositories in size range {lower_bound}..{upper_bound}")
+    if n_results > SEARCH_RESULT_CAP:
+        print(f"Size range {lower_bound}..{upper_bound} now has {n_results} results, only the first {SEARCH_RESULT_CAP} are reachable; delete {PLAN_FILE} to replan")
+    n_query_pages = min(math.ceil(n_results/PER_PAGE), SEARCH_RESULT_CAP // PER_PAGE)
+    # The remaining pages of a window are requested together
+    pages = [first_page] + await asyncio.gather(*(fetch_page(session, lower_bound, upper_bound, page, request_slots) for page in range(2, n_query_pages + 1)))
+    return [(repository['full_name'], repository['stargazers_count'], repository['language'])
+            for page in pages if page for repository in page['items']]
+
+async def download_windows(windows, lower_bound):
+    # Windows run concurrently and finish in any order. The checkpoint only moves past a
+    # window once every window below it is finished, so a resume never skips a gap.
     global repo_list
-    for page in range(1, 3):
-        r = get_request(lower_bound=lower_bound, upper_bound=upper_bound, page=page)
-        
-        if not r:
-            return
-
-        if page == 1:
-            n_results = r.json()['total_count']
-            n_query_pages = min(math.ceil(n_results/100), 10)
-
-        for repository in r.json()['items']:
-            name = repository['full_name']
-            stars = repository['stargazers_count']
-            lang = repository['language']
-            repo_list.append((name, stars, lang))
-            
-            if len(repo_list) >= 10:
-                return
-
-        if page >= n_query_pages:
-            return
+    windows = [(max(lower_bound, window_lower), window_upper, n_results) for window_lower, window_upper, n_results in windows if window_upper >= lower_bound]
+    if not windows:
+        return lower_bound, lower_bound
+    done = [False] * len(windows)
+    frontier = 0
+    window_slots = asyncio.Semaphore(CONCURRENT_WINDOWS)
+    request_slots = asyncio.Semaphore(CONCURRENT_REQUESTS)
+
+    def position():
+        if frontier == len(windows):
+            return windows[-1][1] + 1, windows[-1][1]
+        return windows[frontier][0], windows[frontier][1]
+
+    async def run_window(session, index):
+        window_lower, window_upper, _ = windows[index]
+        async with window_slots:
+            if len(repo_list) >= MAX_REPOS:
+                return index, None
+            return index, await download_range(session, window_lower, window_upper, request_slots)
+
+    async with aiohttp.ClientSession() as session:
+        tasks = [asyncio.ensure_future(run_window(session, index)) for index in range(len(windows))]
+        try:
+            for next_window in asyncio.as_completed(tasks):
+                index, repos = await next_window
+                if repos is None:
+                    continue
+                add_repos(repos)
+                done[index] = True
+                print(f"Total repositories collected: {len(repo_list)}")
+                if done[frontier]:
+                    while frontier < len(windows) and done[frontier]:
+                        frontier += 1
+                    save_ckpt(*position())
+        except (UnexpectedStatusError, aiohttp.ClientError) as e:
+            print(e)
+            for task in tasks:
+                task.cancel()
+            save_ckpt(*position())
+            print("Exiting program.")
+            exit()
+    return position()
 
 if __name__ == '__main__':
-    if os.path.exists(CHECKPOINT_FILE):
+    ckpt_store = CheckpointStore(CHECKPOINT_DB)
+    checkpoint = ckpt_store.load()
+    if checkpoint is None and os.path.exists(CHECKPOINT_FILE):
         with open(CHECKPOINT_FILE, 'rb') as f:
-            lower_bound, upper_bound, repo_list = pickle.load(f)
+            lower_bound, upper_bound, pickled_repos = pickle.load(f)
+        print(f"Importing {len(pickled_repos)} repositories from {CHECKPOINT_FILE}")
+        ckpt_store.save(pickled_repos, lower_bound, upper_bound)
+        checkpoint = ckpt_store.load()
+
+    repo_list = []
+    repo_names = set()
+    if checkpoint is not None:
+        lower_bound, upper_bound, repos = checkpoint
+        add_repos(repos)
         print(f"Loading from {lower_bound}..{upper_bound}")
     else:
         lower_bound = 0
         upper_bound = 5
-        repo_list = []
+    saved_count = len(repo_list)
 
-    if lower_bound >= 100:
+    if lower_bound >= MAX_SIZE:
         print('''
 Checkpoint is for an already completed download of GitHub repository information.
-Please delete the checkpoint file to restart and try again.
+Please delete the checkpoint database (and any old pickled checkpoint) to restart and try again.
             ''')
         exit()
 
-    repo_count = 0
-    while lower_bound < 100 and repo_count < 10:  # Changed upper limit to 1000 MB (roughly 1 GB)
-        upper_bound = max(lower_bound + 1, min(100, lower_bound + 10))  # Simplified range adjustment
-        
-        print(f'Querying size {lower_bound}..{upper_bound}')
-        r = get_request(lower_bound, upper_bound)
-        if not r:
-            break
-        n_results = r.json()['total_count']
-        
-        if n_results > 0:
-            print(f"Downloading repositories in size range {lower_bound}..{upper_bound}")
-            download_range(lower_bound, upper_bound)
-            repo_count = len(repo_list)
-            print(f"Total repositories collected: {repo_count}")
-        
-        lower_bound = upper_bound + 1
+    # Windows below the checkpointed lower bound were already downloaded
+    lower_bound, upper_bound = asyncio.run(download_windows(plan_size_ranges(0, MAX_SIZE), lower_bound))
 
     save_ckpt(lower_bound, upper_bound)
 
     with open(OUTPUT_FILE, 'w') as f:
-        for repo in repo_list[:10]:  # Limit to 10 repositories in the output
-            name, stars, lang = repo
-            f.write(f'{name},{stars},{lang}\n')
+        for repo in repo_list[:MAX_REPOS]:  # Limit to MAX_REPOS repositories in the output
+            # name, stars, lang, then GRAPHQL_FIELDS in graphql mode
+            f.write(','.join(str(value) for value in repo) + '\n')
 
-    print(f"Collected information for {len(repo_list[:10])} repositories.")
\ No newline at end of file
+    print(f"Collected information for {len(repo_list[:MAX_REPOS])} repositories.")
\ No newline at end of file
@@ -0,0 +1,86 @@
+## Compares the legacy blob decode path (read -> BytesIO -> GzipFile.read -> decode) with
+## GzipBlobDecoder on synthetic gzipped blobs, for throughput and allocation. Both paths
+## are first checked to agree on the blobs and on multi-member and padded gzip input.
+##   python bench_decode.py --blobs 200 --size 262144
+
+import io
+import gzip
+import time
+import random
+import string
+import argparse
+import tracemalloc
+
+from blob_decode import GzipBlobDecoder, READ_CHUNK_BYTES, INFLATE_PIECE_BYTES
+
+def make_blobs(count, size, seed):
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(2000)]
+    blobs = []
+    for _ in range(count):
+        text = ' '.join(rng.choice(words) for _ in range(size // 6))[:size]
+        blobs.append(gzip.compress(text.encode('utf-8')))
+    return blobs
+
+def stream(data):
+    # Stands in for an S3 response body read in chunks
+    body = io.BytesIO(data)
+    while True:
+        chunk = body.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return
+        yield chunk
+
+def legacy_decode(data):
+    compressed_data = b''.join(stream(data))
+    with gzip.GzipFile(fileobj=io.BytesIO(compressed_data)) as gzip_file:
+        return gzip_file.read().decode('utf-8')
+
+def check_decoders(decoder, blobs):
+    # Members inflating past INFLATE_PIECE_BYTES followed by more input used to never finish
+    big = b'a' * (INFLATE_PIECE_BYTES + 45000)
+    edge_cases = [
+        gzip.compress(big) + gzip.compress(b'xyz'),
+        gzip.compress(big) + b'\0' * 10,
+        gzip.compress(b'xyz') + gzip.compress(big) + b'\0' * 3,
+    ]
+    for data in blobs + edge_cases:
+        if decoder.decode(stream(data), 'utf-8') != legacy_decode(data):
+            raise SystemExit('GzipBlobDecoder output differs from GzipFile')
+        # One byte per chunk exercises member boundaries that fall inside a chunk
+        if len(data) < 1024 * 1024 and decoder.decode((data[i:i + 1] for i in range(len(data))), 'utf-8') != legacy_decode(data):
+            raise SystemExit('GzipBlobDecoder output differs from GzipFile with 1-byte chunks')
+
+def run(name, decode, blobs, repeat):
+    start_time = time.perf_counter()
+    text_bytes = 0
+    for _ in range(repeat):
+        for data in blobs:
+            text_bytes += len(decode(data))
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    for data in blobs:
+        tracemalloc.reset_peak()
+        decode(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:10} {text_bytes / elapsed / 1e6:8.1f} MB/s   peak allocation per blob {peak / 1024:10.1f} KiB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Blob decode benchmark')
+    parser.add_argument('--blobs', type=int, default=200)
+    parser.add_argument('--size', type=int, default=256 * 1024, help='decompressed bytes per blob')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    blobs = make_blobs(args.blobs, args.size, args.seed)
+    decoder = GzipBlobDecoder()
+    check_decoders(decoder, blobs)
+    print(f"{args.blobs} blobs of {args.size} bytes, {sum(map(len, blobs)) / len(blobs) / 1024:.1f} KiB gzipped on average")
+    run('legacy', legacy_decode, blobs, args.repeat)
+    run('streaming', lambda data: decoder.decode(stream(data), 'utf-8'), blobs, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+
+DEFAULT_MAX_BYTES = 50 * 1024 ** 3
+# Eviction trims down to this fraction of the cap so it does not run on every put
+EVICT_TO_FRACTION = 0.9
+# Hit/miss counters and last_access times are written to the index in batches of this many lookups
+FLUSH_EVERY_LOOKUPS = 512
+
+logger = logging.getLogger(__name__)
+
+
+class BlobCache:
+    """On-disk, content-addressed cache of gzipped Software Heritage blobs keyed by blob_id.
+
+    Blob bytes live in files under cache_dir and an SQLite index (WAL mode) tracks sizes,
+    last access and hit/miss counters, so several worker processes can share one cache.
+    Least recently used blobs are evicted once the total size goes over max_bytes.
+
+    get() never writes to the index: counters and access times are kept in memory and
+    flushed every FLUSH_EVERY_LOOKUPS lookups, with each put, and on flush()/close().
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self._conn = None
+        self._pid = None
+        # Callers may use the cache from several threads (e.g. asyncio.to_thread)
+        self._lock = threading.RLock()
+        # This instance's lookups, for per-run stats
+        self.hits = 0
+        self.misses = 0
+        self._pending_hits = 0
+        self._pending_misses = 0
+        self._pending_access = {}
+
+    def _db(self):
+        # SQLite connections must not cross a fork, so each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), timeout=60, isolation_level=None, check_same_thread=False)
+            self._pending_hits = self._pending_misses = 0
+            self._pending_access = {}
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS blobs (blob_id TEXT PRIMARY KEY, size INTEGER, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS blobs_last_access ON blobs (last_access)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+            self._conn.execute("INSERT OR IGNORE INTO stats VALUES ('total_bytes', 0), ('hits', 0), ('misses', 0)")
+            self._pid = os.getpid()
+        return self._conn
+
+    def _path(self, blob_id):
+        return os.path.join(self.cache_dir, blob_id[:2], blob_id[2:4], blob_id)
+
+    def get(self, blob_id):
+        try:
+            with open(self._path(blob_id), 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                self._pending_misses += 1
+            else:
+                self.hits += 1
+                self._pending_hits += 1
+                self._pending_access[blob_id] = time.time()
+            if self._pending_hits + self._pending_misses >= FLUSH_EVERY_LOOKUPS:
+                self.flush()
+        return data
+
+    def _flush_pending(self, db):
+        db.executemany('UPDATE blobs SET last_access = ? WHERE blob_id = ?', [(t, blob_id) for blob_id, t in self._pending_access.items()])
+        db.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (self._pending_hits,))
+        db.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (self._pending_misses,))
+        self._pending_hits = self._pending_misses = 0
+        self._pending_access = {}
+
+    def flush(self):
+        with self._lock:
+            if not (self._pending_hits or self._pending_misses):
+                return
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                self._flush_pending(db)
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self.flush()
+                self._conn.close()
+            self._conn = None
+
+    def put(self, blob_id, data):
+        path = self._path(blob_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique per call: threads of one process may put the same blob_id at the same time
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            # Content addressed, so a concurrent writer of the same blob_id writes identical bytes
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self._lock:
+            evicted = self._index_put(blob_id, len(data))
+
+        for evicted_id in evicted:
+            try:
+                os.remove(self._path(evicted_id))
+            except OSError:
+                pass
+
+    def _index_put(self, blob_id, size):
+        # Pending counters ride along in the same write transaction
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            self._flush_pending(db)
+            row = db.execute('SELECT size FROM blobs WHERE blob_id = ?', (blob_id,)).fetchone()
+            if row is None:
+                db.execute('INSERT INTO blobs VALUES (?, ?, ?)', (blob_id, size, time.time()))
+                db.execute("UPDATE stats SET value = value + ? WHERE name = 'total_bytes'", (size,))
+            total_bytes = db.execute("SELECT value FROM stats WHERE name = 'total_bytes'").fetchone()[0]
+            evicted = self._evict(db, total_bytes) if total_bytes > self.max_bytes else []
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return evicted
+
+    def _evict(self, db, total_bytes):
+        target = self.max_bytes * EVICT_TO_FRACTION
+        evicted = []
+        freed = 0
+        for blob_id, size in db.execute('SELECT blob_id, size FROM blobs ORDER BY last_access'):
+            if total_bytes - freed <= target:
+                break
+            evicted.append(blob_id)
+            freed += size
+        db.executemany('DELETE FROM blobs WHERE blob_id = ?', [(blob_id,) for blob_id in evicted])
+        db.execute("UPDATE stats SET value = value - ? WHERE name = 'total_bytes'", (freed,))
+        logger.info(f"Evicted {len(evicted)} blobs ({freed} bytes) from {self.cache_dir}")
+        return evicted
+
+    def stats(self):
+        # hits/misses/hit_rate are this instance's lookups; total_bytes is the whole cache
+        with self._lock:
+            total_bytes = self._db().execute("SELECT value FROM stats WHERE name = 'total_bytes'").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'total_bytes': total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,88 @@
+import zlib
+
+DEFAULT_MAX_DECOMPRESSED_BYTES = 64 * 1024 * 1024
+DEFAULT_INITIAL_CAPACITY = 1024 * 1024
+# A buffer grown past this by one large blob is dropped after that blob, so long-lived
+# per-thread decoders hold at most this much between blobs
+DEFAULT_RETAIN_BYTES = 4 * 1024 * 1024
+READ_CHUNK_BYTES = 256 * 1024
+INFLATE_PIECE_BYTES = 64 * 1024
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+
+class BlobTooLargeError(ValueError):
+    pass
+
+
+class GzipBlobDecoder:
+    """Streams gzip chunks into one reusable buffer and decodes the result once.
+
+    Compared with read() -> BytesIO -> GzipFile.read() -> decode(), no full copy of the
+    compressed or decompressed blob is made besides the final str. The buffer is reused
+    while it stays within retain_bytes, so steady-state decoding does not allocate it again;
+    after a larger blob it shrinks back to initial_capacity. Blobs that inflate beyond
+    max_bytes raise BlobTooLargeError as soon as the limit is crossed. A decoder is not
+    thread-safe; use one per thread.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_DECOMPRESSED_BYTES, initial_capacity=DEFAULT_INITIAL_CAPACITY, retain_bytes=DEFAULT_RETAIN_BYTES):
+        self.max_bytes = max_bytes
+        self.initial_capacity = min(initial_capacity, max_bytes)
+        self.retain_bytes = retain_bytes
+        self.buffer = bytearray(self.initial_capacity)
+
+    def _append(self, length, piece):
+        end = length + len(piece)
+        if end > len(self.buffer):
+            grown = bytearray(min(max(end, 2 * len(self.buffer)), self.max_bytes))
+            grown[:length] = self.buffer[:length]
+            self.buffer = grown
+        self.buffer[length:end] = piece
+        return end
+
+    def _feed(self, decompressor, data, length):
+        # Inflates in bounded pieces so no single allocation scales with the blob size
+        while True:
+            # Asking for one byte more than the budget is enough to detect an oversized blob
+            limit = min(INFLATE_PIECE_BYTES, self.max_bytes - length + 1)
+            piece = decompressor.decompress(data, limit)
+            if length + len(piece) > self.max_bytes:
+                raise BlobTooLargeError(f"Blob inflates to more than {self.max_bytes} bytes")
+            length = self._append(length, piece)
+            if decompressor.eof:
+                # Bytes after the member also stay in unconsumed_tail when max_length was hit;
+                # feeding them again would loop forever, inflate() continues from unused_data
+                return length
+            data = decompressor.unconsumed_tail
+            if not data and len(piece) < limit:
+                return length
+
+    def inflate(self, chunks):
+        # Returns the number of decompressed bytes now at the start of self.buffer
+        length = 0
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        for chunk in chunks:
+            while chunk:
+                length = self._feed(decompressor, chunk, length)
+                # Concatenated gzip members continue in unused_data; null padding is ignored like gzip does
+                chunk = decompressor.unused_data if decompressor.eof else b''
+                if chunk.strip(b'\x00'):
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                else:
+                    chunk = b''
+        piece = decompressor.flush()
+        if length + len(piece) > self.max_bytes:
+            raise BlobTooLargeError(f"Blob inflates to more than {self.max_bytes} bytes")
+        length = self._append(length, piece)
+        if not decompressor.eof:
+            raise EOFError("Compressed blob ended before the end-of-stream marker was reached")
+        return length
+
+    def decode(self, chunks, encoding):
+        try:
+            length = self.inflate(chunks)
+            with memoryview(self.buffer) as view:
+                return str(view[:length], encoding)
+        finally:
+            if len(self.buffer) > self.retain_bytes:
+                self.buffer = bytearray(self.initial_capacity)
@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import time
+import random
+import zlib
+
+import aioboto3
+import pyarrow as pa
+import pyarrow.compute as pc
+from aiobotocore.config import AioConfig
+
+from blob_decode import GzipBlobDecoder, BlobTooLargeError, DEFAULT_MAX_DECOMPRESSED_BYTES
+
+SWH_BUCKET = 'softwareheritage'
+SWH_PREFIX = 'content/'
+DEFAULT_MAX_IN_FLIGHT = 1000
+# Runs of anything that is not str.isspace() whitespace, so the count matches len(content.split())
+WORD_PATTERN = '[^\t\n\x0b\x0c\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]+'
+
+# S3 error codes and HTTP statuses that mean "slow down" rather than "this blob is broken"
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests', 'ServiceUnavailable', '503'}
+THROTTLE_STATUSES = {429, 503}
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 10.0
+
+# Routing by the uncompressed length_bytes column: blobs at or above LARGE_BLOB_BYTES get
+# their own small lane and are fetched as parallel ranged GETs of RANGE_PART_BYTES
+LENGTH_COLUMN = 'length_bytes'
+LARGE_BLOB_BYTES = 4 * 1024 * 1024
+RANGE_PART_BYTES = 4 * 1024 * 1024
+DEFAULT_LARGE_LANE_WORKERS = 8
+
+logger = logging.getLogger(__name__)
+
+
+def is_throttle_error(error):
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLE_CODES or status in THROTTLE_STATUSES
+
+
+def is_retryable_error(error):
+    # Throttling, 5xx and connection-level failures are worth another try; other 4xx and
+    # blobs that cannot be decoded are not
+    if isinstance(error, (BlobTooLargeError, UnicodeError, EOFError, zlib.error, LookupError)):
+        return False
+    response = getattr(error, 'response', None)
+    if not response:
+        return True
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return is_throttle_error(error) or status >= 500
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight GETs, fed back from observed latency, errors and throttling.
+
+    After each window of completed requests the limit grows by `increase` if latency and
+    error rate were healthy. Any throttling response (503 SlowDown, 429) or a window with too
+    many congestion errors cuts it by `decrease_factor`, at most once per `cooldown` seconds
+    so one burst of 503s counts once. Errors that are not congestion (NoSuchKey, AccessDenied)
+    do not count.
+    """
+
+    def __init__(self, initial=64, min_limit=4, max_limit=DEFAULT_MAX_IN_FLIGHT, increase=8,
+                 decrease_factor=0.5, latency_target=1.0, max_error_rate=0.02, cooldown=1.0):
+        self.limit = min(max(initial, min_limit), max_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.completed = 0
+        self.throttled = 0
+        self.bytes = 0
+        self.last_throughput = 0.0
+        self.last_byte_rate = 0.0
+        self._condition = None
+        self._last_decrease = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+        self._window_bytes = 0
+
+    async def acquire(self):
+        # Created on first use so it belongs to the fetcher's event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            # Wake only as many waiters as there are free slots: one normally, more after the
+            # limit grew. notify_all would wake every idle worker just to re-check and sleep.
+            self._condition.notify(max(0, self.limit - self.in_flight))
+
+    def record_success(self, latency, nbytes):
+        self.completed += 1
+        self.bytes += nbytes
+        self._window_requests += 1
+        self._window_latency += latency
+        self._window_bytes += nbytes
+        self._maybe_adjust()
+
+    def record_error(self, throttled=False, congestion=True):
+        # Only throttling, 5xx and connection errors say anything about how hard S3 is pushed;
+        # a missing or forbidden blob must not pin the limit at min_limit
+        if not congestion:
+            return
+        self._window_requests += 1
+        self._window_errors += 1
+        if throttled:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+                self._last_decrease = now
+                logger.info(f"Throttled by S3, fetch concurrency cut to {self.limit}")
+        self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        if self._window_requests < self.limit:
+            return
+        elapsed = max(time.monotonic() - self._window_start, 1e-6)
+        successes = self._window_requests - self._window_errors
+        self.last_throughput = successes / elapsed
+        self.last_byte_rate = self._window_bytes / elapsed
+        error_rate = self._window_errors / self._window_requests
+        mean_latency = self._window_latency / successes if successes else float('inf')
+        if error_rate > self.max_error_rate:
+            if time.monotonic() - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, int(self.limit * self.decrease_factor))
+                self._last_decrease = time.monotonic()
+        elif mean_latency <= self.latency_target and time.monotonic() - self._last_decrease >= self.cooldown:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+        logger.debug(f"Fetch concurrency {self.limit}: {self.last_throughput:.0f} req/s, {mean_latency * 1000:.0f} ms mean, {error_rate:.1%} errors")
+        self._reset_window()
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'throttled': self.throttled,
+            'requests_per_sec': self.last_throughput,
+            'bytes_per_sec': self.last_byte_rate,
+        }
+
+
+class AsyncBlobFetcher:
+    """Fetches Software Heritage blobs with many GETs in flight over one shared connection pool.
+
+    The event loop and S3 client live as long as the fetcher, so connections stay warm
+    between calls to fetch_all. Results always come back in the order of the input keys.
+    """
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, bucket=SWH_BUCKET, prefix=SWH_PREFIX, cache=None, track_latency=False,
+                 adaptive=False, max_attempts=3, max_blob_bytes=DEFAULT_MAX_DECOMPRESSED_BYTES,
+                 large_blob_bytes=LARGE_BLOB_BYTES, large_lane_workers=DEFAULT_LARGE_LANE_WORKERS):
+        self.max_in_flight = max_in_flight
+        self.max_blob_bytes = max_blob_bytes
+        self.large_blob_bytes = large_blob_bytes
+        self.large_lane_workers = large_lane_workers
+        self.cache = cache
+        # With adaptive=True, max_in_flight is the ceiling and the limiter picks the actual concurrency
+        self.limiter = AdaptiveConcurrencyLimiter(max_limit=max_in_flight) if adaptive else None
+        self.max_attempts = max_attempts
+        # Rows that still failed after retries, for dead-letter output; drained by take_failures()
+        self.failures = []
+        # Decoding never awaits, so the event loop thread can share one decoder
+        self.decoder = GzipBlobDecoder(max_bytes=max_blob_bytes)
+        # Seconds per S3 GET, kept only when asked for (e.g. by the benchmark)
+        self.latencies = [] if track_latency else None
+        self.bucket = bucket
+        self.prefix = prefix
+        self.loop = asyncio.new_event_loop()
+        self._client_context = None
+        self._client = None
+
+    async def _get_client(self):
+        if self._client is None:
+            # Retries happen in fetch_compressed so the limiter sees every throttling response
+            config = AioConfig(
+                max_pool_connections=self.max_in_flight,
+                retries={'max_attempts': 1, 'mode': 'standard'}
+            )
+            self._client_context = aioboto3.Session().client('s3', config=config)
+            self._client = await self._client_context.__aenter__()
+        return self._client
+
+    async def fetch_compressed(self, blob_id, length=None):
+        # Cache file reads and index writes run off the event loop so they never stall other GETs
+        if self.cache is not None:
+            compressed_data = await asyncio.to_thread(self.cache.get, blob_id)
+            if compressed_data is not None:
+                return compressed_data
+
+        if length is not None and length >= self.large_blob_bytes:
+            compressed_data = await self._get_ranged(blob_id)
+        else:
+            compressed_data, _ = await self._get_with_retries(blob_id)
+        if self.cache is not None:
+            try:
+                await asyncio.to_thread(self.cache.put, blob_id, compressed_data)
+            except Exception as e:
+                # The GET succeeded; a cache that cannot take the blob must not fail the row
+                logger.warning(f"Could not cache blob_id {blob_id}: {e}")
+        return compressed_data
+
+    async def _get_with_retries(self, blob_id, byte_range=None):
+        for attempt in range(self.max_attempts):
+            try:
+                return await self._get_object(blob_id, byte_range)
+            except Exception as e:
+                if attempt + 1 == self.max_attempts or not is_retryable_error(e):
+                    raise
+                await asyncio.sleep(min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    async def _get_ranged(self, blob_id):
+        # The first part also tells us the compressed size; the remaining parts go out together
+        first, content_range = await self._get_with_retries(blob_id, (0, RANGE_PART_BYTES - 1))
+        total = int(content_range.rsplit('/', 1)[1]) if content_range else len(first)
+        ranges = [(start, min(start + RANGE_PART_BYTES, total) - 1) for start in range(RANGE_PART_BYTES, total, RANGE_PART_BYTES)]
+        parts = await asyncio.gather(*(self._get_with_retries(blob_id, byte_range) for byte_range in ranges))
+        return b''.join([first] + [data for data, _ in parts])
+
+    async def _get_object(self, blob_id, byte_range=None):
+        client = await self._get_client()
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        start_time = time.monotonic()
+        params = {'Range': f'bytes={byte_range[0]}-{byte_range[1]}'} if byte_range else {}
+        try:
+            response = await client.get_object(Bucket=self.bucket, Key=f'{self.prefix}{blob_id}', **params)
+            async with response['Body'] as stream:
+                compressed_data = await stream.read()
+        except Exception as e:
+            if self.limiter is not None:
+                self.limiter.record_error(throttled=is_throttle_error(e), congestion=is_retryable_error(e))
+            raise
+        finally:
+            if self.limiter is not None:
+                await self.limiter.release()
+        latency = time.monotonic() - start_time
+        if self.latencies is not None:
+            self.latencies.append(latency)
+        if self.limiter is not None:
+            self.limiter.record_success(latency, len(compressed_data))
+        return compressed_data, response.get('ContentRange')
+
+    async def fetch_text(self, blob_id, src_encoding, length=None):
+        try:
+            if length is not None and length > self.max_blob_bytes:
+                # Known to be over the limit from metadata: skip without a GET
+                raise BlobTooLargeError(f"length_bytes {length} exceeds {self.max_blob_bytes} bytes")
+            compressed_data = await self.fetch_compressed(blob_id, length)
+            return self.decoder.decode([compressed_data], src_encoding)
+        except Exception as e:
+            if isinstance(e, BlobTooLargeError):
+                logger.warning(f"Skipping blob_id {blob_id}: {e}")
+            else:
+                logger.error(f"Error downloading blob_id {blob_id}: {e}")
+            retryable = is_retryable_error(e)
+            self.failures.append({
+                'blob_id': blob_id,
+                'src_encoding': src_encoding,
+                'error_class': type(e).__name__,
+                'error': str(e)[:1000],
+                'retryable': retryable,
+                'attempts': self.max_attempts if retryable else 1,
+            })
+            return ""
+
+    async def fetch_blob(self, blob_id, src_encoding, length=None):
+        content = await self.fetch_text(blob_id, src_encoding, length)
+        return {"text": content, "word_count": len(content.split())}
+
+    async def fetch_many(self, keys, count_words=True):
+        # keys are (blob_id, src_encoding) or (blob_id, src_encoding, length_bytes)
+        fetch = self.fetch_blob if count_words else self.fetch_text
+        results = [None] * len(keys)
+        large = [index for index, key in enumerate(keys) if len(key) > 2 and key[2] is not None and key[2] >= self.large_blob_bytes]
+        large_set = set(large)
+        small = iter([index for index in range(len(keys)) if index not in large_set])
+        large = iter(large)
+
+        # Each lane is a fixed set of workers pulling indexes from one shared iterator, which
+        # caps in-flight requests without creating a task per row. Large blobs have their own
+        # few workers, so they never hold the slots the small blobs are waiting for.
+        async def worker(pending):
+            for index in pending:
+                results[index] = await fetch(*keys[index])
+
+        await asyncio.gather(
+            *(worker(small) for _ in range(min(self.max_in_flight, len(keys) - len(large_set)))),
+            *(worker(large) for _ in range(min(self.large_lane_workers, len(large_set)))),
+        )
+        return results
+
+    def take_failures(self):
+        failures, self.failures = self.failures, []
+        return failures
+
+    def fetch_all(self, keys, count_words=True):
+        return self.loop.run_until_complete(self.fetch_many(list(keys), count_words))
+
+    def close(self):
+        # The cache is opened for this fetcher by every caller, so the fetcher closes it
+        if self.cache is not None:
+            self.cache.close()
+        if self._client_context is not None:
+            self.loop.run_until_complete(self._client_context.__aexit__(None, None, None))
+            self._client_context = None
+            self._client = None
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def count_words(text):
+    # Vectorized word count over an Arrow string array (int32 per row)
+    return pc.count_substring_regex(text, WORD_PATTERN)
+
+
+def fetch_text_column(fetcher, batch):
+    columns = [batch.column('blob_id').to_pylist(), batch.column('src_encoding').to_pylist()]
+    if batch.schema.get_field_index(LENGTH_COLUMN) >= 0:
+        columns.append(batch.column(LENGTH_COLUMN).to_pylist())
+    keys = list(zip(*columns))
+    return pa.array(fetcher.fetch_all(keys, count_words=False), pa.string())
+
+
+def enrich_record_batch(fetcher, batch):
+    # Attaches text and word_count to the batch positionally, in the batch's own row order
+    text = fetch_text_column(fetcher, batch)
+    return batch.append_column('text', text).append_column('word_count', count_words(text))
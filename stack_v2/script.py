@@ -1,16 +1,30 @@
 from pyspark.sql import SparkSession
-from pyspark.sql.types import StringType, IntegerType, StructType, StructField
+from pyspark.sql.types import StringType, IntegerType, LongType, StructType, StructField
 import boto3
 import concurrent.futures
 from tqdm import tqdm
 from botocore.config import Config
-import gzip
+from boto3.s3.transfer import TransferConfig
 import boto3
-import io
+import threading
 import gc
 import os
+import time
+import hashlib
+import socket
 from multiprocessing import cpu_count
 
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.fs as pafs
+from pyspark import TaskContext
+
+from blob_fetch import AsyncBlobFetcher, enrich_record_batch, is_retryable_error, count_words, LENGTH_COLUMN
+from blob_decode import GzipBlobDecoder, BlobTooLargeError, READ_CHUNK_BYTES
+from work_units import read_footer, plan_row_group_units, iter_unit_batches, filesystem_for
+from blob_cache import BlobCache
+from work_scheduler import WorkScheduler, open_lease_store
+
 
 config = Config(
     retries = {
@@ -24,6 +38,55 @@ s3_client_1 = boto3.client(
 config = config
 )
 
+FETCH_ENGINE = 'executor'  # 'executor' fetches inside Spark tasks, 'async' or 'pool' fetch on the driver
+FETCH_MAX_IN_FLIGHT = 2000  # Ceilings when FETCH_ADAPTIVE is on
+MAX_BLOB_BYTES = 64 * 1024 * 1024  # Blobs inflating past this are skipped
+OUTPUT_BUCKET = 'llm-spark'
+OUTPUT_PREFIX = 'stack_v2/processed_data'
+# Rows recovered by retry_dead_letters, as (blob_id, text, word_count), kept out of OUTPUT_PREFIX so
+# that prefix holds one schema. Consumers merge by joining on blob_id and taking the recovered
+# text/word_count where present (the partition rows for those blobs have text "").
+RECOVERED_PREFIX = 'stack_v2/recovered_data'
+STREAM_UPLOADS = True  # Upload each partition file as soon as it is written, then delete it locally
+MAX_PENDING_UPLOADS = 2
+UPLOAD_CONCURRENCY = 10
+UPLOAD_CHUNK_BYTES = 64 * 1024 * 1024
+ROW_MAX_ATTEMPTS = 4  # Fetch attempts per row in the process pool before it is dead-lettered
+ROW_RETRY_BASE_DELAY = 5
+ROW_RETRY_MAX_DELAY = 60
+FETCH_ADAPTIVE = True  # Let the AIMD limiter pick in-flight GETs from latency and S3 throttling
+EXECUTOR_MAX_IN_FLIGHT = 200  # Per Spark task, each executor has one core
+INPUT_BUCKET = 'llm-spark'
+ROWS_PER_UNIT = 800000  # Target rows per partition / work unit
+PLAN_MODE = 'footer'  # 'footer' plans units from Parquet row groups, 'repartition' counts and shuffles by blob_id
+PARTITION_MODE = 'single_pass'  # 'single_pass' runs every partition in one job (always fetches in executors), 'loop' runs one job per partition
+SCHEDULER_ROOT = './extr1/_scheduler'  # Shared directory or 's3://bucket/prefix' holding the plan, leases, done markers and dead letters
+LOCAL_ROOT = './extr1'  # Partition files until uploaded; must be a shared mount for the driver's sweep when STREAM_UPLOADS is off
+LEASE_SECONDS = 3600  # Leases are renewed every LEASE_SECONDS / 3; a crashed worker's units are retaken after this
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+UNIT_MAX_ATTEMPTS = 3
+PLAN_THREADS = 32  # Footer reads in parallel when building the work list
+
+decoders = threading.local()
+upload_client = None
+upload_transfer_config = TransferConfig(multipart_threshold=UPLOAD_CHUNK_BYTES, multipart_chunksize=UPLOAD_CHUNK_BYTES, max_concurrency=UPLOAD_CONCURRENCY)
+
+dead_letter_schema = pa.schema([
+    ('blob_id', pa.string()),
+    ('src_encoding', pa.string()),
+    ('error_class', pa.string()),
+    ('error', pa.string()),
+    ('retryable', pa.bool_()),
+    ('attempts', pa.int32()),
+])
+
+partition_summary_schema = StructType([
+    StructField("partition_id", IntegerType(), False),
+    StructField("rows", LongType(), False)
+])
+BLOB_CACHE_DIR = '/tmp/swh_blob_cache'  # Set to None to disable the local blob cache
+BLOB_CACHE_MAX_BYTES = 50 * 1024 ** 3
+
 
 os.environ['PYSPARK_PYTHON'] = '/home/ubuntu/miniconda/bin/python3'
 os.environ['PYSPARK_DRIVER_PYTHON'] = '/home/ubuntu/miniconda/bin/python3'
@@ -44,6 +107,11 @@ def list_s3_files(bucket_name, prefix):
 
 
 
+def thread_decoder():
+    if not hasattr(decoders, 'decoder'):
+        decoders.decoder = GzipBlobDecoder(max_bytes=MAX_BLOB_BYTES)
+    return decoders.decoder
+
 def download_contents(blob_id, src_encoding):
     # s3_url = f"s3://softwareheritage/content/{blob_id}"
     # s3_url = "s3://llm-spark/e380d116d6416bf303fbcacad06dec3a409d740f"
@@ -53,52 +121,70 @@ def download_contents(blob_id, src_encoding):
     try:
         # Fetch the object from S3
         response = s3_client_1.get_object(Bucket=bucket_name, Key=f'content/{blob_id}')
-        compressed_data = response['Body'].read()
-        
-        # Decompress gzip-compressed data
-        with gzip.GzipFile(fileobj=io.BytesIO(compressed_data)) as gzip_file:
-            content = gzip_file.read().decode(src_encoding)
+
+        # Inflate straight from the response stream into this thread's reusable buffer
+        content = thread_decoder().decode(response['Body'].iter_chunks(READ_CHUNK_BYTES), src_encoding)
         
         # Return the content and word count
-        return {"text": content, "word_count": len(content.split())}
+        return {"text": content, "word_count": len(content.split()), "error": None}
     
+    except BlobTooLargeError as e:
+        print(f"Skipping blob_id {blob_id}: {e}")
+        return {"text": "", "word_count": 0, "error": e}
+
     except Exception as e:
         # Handle exceptions (e.g., S3 errors, gzip errors, decoding errors)
         print(f"Error downloading or processing blob_id {blob_id}: {e}")
-        return {"text": "", "word_count": 0}
+        return {"text": "", "word_count": 0, "error": e}
 
 
 
 def process_row_in_thread(blob_id, src_encoding):
     # This function is designed to be run in a thread
     content_data = download_contents(blob_id, src_encoding)
-    return blob_id, content_data['text'], content_data['word_count']
+    return blob_id, src_encoding, content_data
+
+def failure_record(blob_id, src_encoding, error, retryable):
+    return {
+        'blob_id': blob_id,
+        'src_encoding': src_encoding,
+        'error_class': type(error).__name__,
+        'error': str(error)[:1000],
+        'retryable': retryable,
+    }
 
 def process_data_in_process(data_chunk):
     results = []
+    failures = []
     max_threads =  25 # Number of threads per process
 
     # Thread pool within each process
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as thread_executor:
-        future_to_row = {thread_executor.submit(process_row_in_thread, d['blob_id'], d['src_encoding']): d for d in data_chunk}
+        future_to_row = {thread_executor.submit(process_row_in_thread, blob_id, src_encoding): (blob_id, src_encoding) for blob_id, src_encoding in data_chunk}
         
         for future in concurrent.futures.as_completed(future_to_row):
+            blob_id, src_encoding = future_to_row[future]
             try:
-                row_result = future.result()
-                results.append(row_result)
+                blob_id, src_encoding, content_data = future.result()
+                error = content_data['error']
             except Exception as e:
-                print(f"Error processing row: {e}")
+                error = e
+            if error is None:
+                results.append((blob_id, content_data['text'], content_data['word_count']))
+            else:
+                failures.append(failure_record(blob_id, src_encoding, error, is_retryable_error(error)))
     gc.collect()
 
-    return results
+    return results, failures
 
-def process_data_in_parallel(data, failed_try=0):
+def fetch_rows_in_pool(rows):
     # Split data into chunks based on the number of available CPU cores
-    max_processes = int(min(cpu_count(), len(data))-20) # Limit the number of processes
-    chunk_size = (len(data) // max_processes)  # Data chunk size for each process
+    max_processes = max(1, int(min(cpu_count(), len(rows))-20)) # Limit the number of processes
+    chunk_size = max(1, len(rows) // max_processes)  # Data chunk size for each process
 
-    data_chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    data_chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
     results = []
+    failures = []
 
     print("MAx_worker", max_processes)
     # Process pool across all data chunks
@@ -108,25 +194,280 @@ def process_data_in_parallel(data, failed_try=0):
         for future in tqdm(concurrent.futures.as_completed(future_to_chunk), total=len(future_to_chunk), desc="Processing chunks in process pool"):
 
             try:
-                chunk_results = future.result()
+                chunk_results, chunk_failures = future.result()
                 results.extend(chunk_results)
+                failures.extend(chunk_failures)
             except Exception as e:
-                failed_try+=1
-                if failed_try<3:
-                    print("Trying again")
-                    results = process_data_in_parallel(data, failed_try=failed_try)
+                # Only this chunk's rows are retried, the rest of the results are kept
                 print(f"Error processing chunk: {e}")
+                failures.extend(failure_record(blob_id, src_encoding, e, True) for blob_id, src_encoding in future_to_chunk[future])
     gc.collect()
 
+    return results, failures
+
+def process_data_in_parallel(data, dead_letters=None):
+    # Failed rows are retried on their own with backoff; rows that still fail go to dead_letters
+    pending = []
+    results = []
+    failures = []
+    for d in data:
+        length = d.get(LENGTH_COLUMN)
+        if length is not None and length > MAX_BLOB_BYTES:
+            error = BlobTooLargeError(f"length_bytes {length} exceeds {MAX_BLOB_BYTES} bytes")
+            failures.append({**failure_record(d['blob_id'], d['src_encoding'], error, False), 'attempts': 0})
+        else:
+            pending.append((d['blob_id'], d['src_encoding']))
+    if failures:
+        print(f"Skipping {len(failures)} rows over {MAX_BLOB_BYTES} bytes by length_bytes")
+    for attempt in range(1, ROW_MAX_ATTEMPTS + 1):
+        if attempt > 1:
+            delay = min(ROW_RETRY_MAX_DELAY, ROW_RETRY_BASE_DELAY * 2 ** (attempt - 2))
+            print(f"Retrying {len(pending)} failed rows in {delay:.0f}s (attempt {attempt} of {ROW_MAX_ATTEMPTS})")
+            time.sleep(delay)
+        attempt_results, attempt_failures = fetch_rows_in_pool(pending)
+        results.extend(attempt_results)
+        pending = []
+        for failure in attempt_failures:
+            failure['attempts'] = attempt
+            if failure['retryable'] and attempt < ROW_MAX_ATTEMPTS:
+                pending.append((failure['blob_id'], failure['src_encoding']))
+            else:
+                failures.append(failure)
+        if not pending:
+            break
+
+    print(f"{len(results)} rows fetched, {len(failures)} rows dead-lettered")
+    if dead_letters is not None:
+        dead_letters.extend(failures)
     return results
 
-# Read the Parquet files from S3
+def process_data_async(data, dead_letters=None):
+    # One process, many GETs in flight over a shared connection pool; results keep input order
+    keys = [(d['blob_id'], d['src_encoding'], d.get(LENGTH_COLUMN)) for d in data]
+    cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_DIR else None
+    with AsyncBlobFetcher(max_in_flight=FETCH_MAX_IN_FLIGHT, cache=cache, adaptive=FETCH_ADAPTIVE, max_blob_bytes=MAX_BLOB_BYTES) as fetcher:
+        fetched = fetcher.fetch_all(keys)
+        if dead_letters is not None:
+            dead_letters.extend(fetcher.take_failures())
+        if fetcher.limiter is not None:
+            print("Fetch concurrency", fetcher.limiter.stats())
+        if cache is not None:
+            print("Blob cache stats", cache.stats())
+    return [(key[0], result['text'], result['word_count']) for key, result in zip(keys, fetched)]
+
+def make_partition_enricher(dead_dir, partition_id):
+    # Runs inside a Spark task: full Arrow batches in, the same rows with text and word_count
+    # attached positionally out, with one fetcher per task and no text sent to the driver.
+    # Only the task holding partition_id gets rows; it writes that partition's dead letters.
+    def enrich_partition(batches):
+        cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_DIR else None
+        with AsyncBlobFetcher(max_in_flight=EXECUTOR_MAX_IN_FLIGHT, cache=cache, adaptive=FETCH_ADAPTIVE, max_blob_bytes=MAX_BLOB_BYTES) as fetcher:
+            rows = 0
+            for batch in batches:
+                rows += batch.num_rows
+                yield enrich_record_batch(fetcher, batch)
+            if rows:
+                write_dead_letters(dead_dir, partition_id, fetcher.take_failures())
+    return enrich_partition
+
+def order_results(data, results):
+    # Puts (text, word_count) back in the order of data; the process pool returns them as completed
+    by_blob_id = {blob_id: (text, word_count) for blob_id, text, word_count in results}
+    return [by_blob_id.get(d['blob_id'], ("", 0)) for d in data]
+
+def make_result_attacher(results_broadcast):
+    # Zips driver-side results onto the partition's rows in order, so no join is needed
+    def attach_results(batches):
+        results = results_broadcast.value
+        offset = 0
+        for batch in batches:
+            chunk = results[offset:offset + batch.num_rows]
+            offset += batch.num_rows
+            text = pa.array([text for text, _ in chunk], pa.string())
+            word_count = pa.array([word_count for _, word_count in chunk], pa.int32())
+            yield batch.append_column('text', text).append_column('word_count', word_count)
+    return attach_results
+
+def list_state_files(state_dir, suffix):
+    # Markers and dead letters live under SCHEDULER_ROOT, so the driver sees what every executor wrote
+    fs, path = filesystem_for(state_dir)
+    infos = fs.get_file_info(pafs.FileSelector(path, allow_not_found=True))
+    return sorted(info.base_name for info in infos if info.type == pafs.FileType.File and info.base_name.endswith(suffix))
+
+def completed_partitions(marker_dir):
+    return {int(name.split('.')[0]) for name in list_state_files(marker_dir, '.done')}
+
+def mark_partition_done(marker_dir, partition_id, rows=None):
+    fs, path = filesystem_for(marker_dir)
+    fs.create_dir(path, recursive=True)
+    with fs.open_output_stream(f'{path}/{partition_id}.done') as f:
+        f.write(('' if rows is None else str(rows)).encode())
+
+def write_dead_letters(dead_dir, partition_id, failures):
+    fs, path = filesystem_for(dead_dir)
+    file_path = f'{path}/{partition_id}.parquet'
+    if not failures:
+        if fs.get_file_info(file_path).type == pafs.FileType.File:
+            fs.delete_file(file_path)
+        return
+    fs.create_dir(path, recursive=True)
+    pq.write_table(pa.Table.from_pylist(failures, schema=dead_letter_schema), file_path, filesystem=fs)
+    print(f"Wrote {len(failures)} failed rows of partition {partition_id} to {dead_dir}/{partition_id}.parquet")
+
+def retry_dead_letters(dead_dir, recovered_dir):
+    # A rerun refetches only dead-lettered rows; recovered rows (blob_id, text, word_count)
+    # are written to recovered_dir and uploaded under RECOVERED_PREFIX
+    names = list_state_files(dead_dir, '.parquet')
+    if not names:
+        return
+    fs, path = filesystem_for(dead_dir)
+    cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_DIR else None
+    with AsyncBlobFetcher(max_in_flight=FETCH_MAX_IN_FLIGHT, cache=cache, adaptive=FETCH_ADAPTIVE, max_blob_bytes=MAX_BLOB_BYTES) as fetcher:
+        for name in names:
+            rows = pq.read_table(f'{path}/{name}', filesystem=fs).to_pylist()
+            retry_rows = [row for row in rows if row['retryable']]
+            if not retry_rows:
+                continue
+            texts = fetcher.fetch_all([(row['blob_id'], row['src_encoding']) for row in retry_rows], count_words=False)
+            still_failed = {failure['blob_id']: failure for failure in fetcher.take_failures()}
+            recovered = [(row['blob_id'], text) for row, text in zip(retry_rows, texts) if row['blob_id'] not in still_failed]
+            if recovered:
+                text = pa.array([text for _, text in recovered], pa.string())
+                os.makedirs(recovered_dir, exist_ok=True)
+                pq.write_table(
+                    pa.table({'blob_id': [blob_id for blob_id, _ in recovered], 'text': text, 'word_count': count_words(text)}),
+                    os.path.join(recovered_dir, f"{name.split('.')[0]}-{int(time.time())}.parquet"),
+                    compression='snappy'
+                )
+
+            remaining = []
+            for row in rows:
+                failure = still_failed.get(row['blob_id'])
+                if not row['retryable']:
+                    remaining.append(row)
+                elif failure is not None:
+                    failure['attempts'] += row['attempts']
+                    remaining.append(failure)
+            print(f"Dead letters {name}: {len(recovered)} recovered, {len(remaining)} still failing")
+            write_dead_letters(dead_dir, name.split('.')[0], remaining)
+
+def get_upload_client():
+    global upload_client
+    if upload_client is None:
+        upload_client = boto3.client('s3', config=Config(max_pool_connections=UPLOAD_CONCURRENCY))
+    return upload_client
+
+def expected_etag(path):
+    # ETag S3 reports for an upload with UPLOAD_CHUNK_BYTES parts: plain MD5, or MD5 of part MD5s
+    digests = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_BYTES), b''):
+            digests.append(hashlib.md5(chunk).digest())
+    if os.path.getsize(path) < UPLOAD_CHUNK_BYTES:
+        return digests[0].hex() if digests else hashlib.md5(b'').hexdigest()
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+def upload_and_verify(path, s3_key):
+    # The local copy is only deleted once S3 reports the same size and ETag
+    client = get_upload_client()
+    client.upload_file(path, OUTPUT_BUCKET, s3_key, Config=upload_transfer_config)
+    head = client.head_object(Bucket=OUTPUT_BUCKET, Key=s3_key)
+    if head['ContentLength'] != os.path.getsize(path) or head['ETag'].strip('"') != expected_etag(path):
+        raise IOError(f"Uploaded s3://{OUTPUT_BUCKET}/{s3_key} does not match {path}")
+    os.remove(path)
+
+def upload_tree(local_dir, s3_prefix, max_workers=UPLOAD_CONCURRENCY):
+    # Uploads everything still under local_dir, e.g. Spark output directories or leftovers from failed uploads
+    # *.tmp are partial writes (e.g. a unit that failed mid-way) and must never be published
+    files_to_upload = [os.path.join(root, file) for root, dirs, files in os.walk(local_dir) for file in files if not file.endswith('.tmp')]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as upload_executor:
+        futures = [upload_executor.submit(upload_and_verify, file, f"{s3_prefix}/{os.path.relpath(file, local_dir)}") for file in files_to_upload]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Uploading files"):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error uploading file: {e}")
+    for root, dirs, files in os.walk(local_dir, topdown=False):
+        if not os.listdir(root):
+            os.rmdir(root)
+
+def write_enriched_partition(batches, local_dir, marker_dir, partition_id, dead_dir, s3_prefix):
+    # Enriches one partition's Arrow batches into <partition_id>.parquet, then drops its marker
+    local_file = f"{local_dir}/{partition_id}.parquet"
+    tmp_file = f"{local_file}.tmp"
+    os.makedirs(local_dir, exist_ok=True)
+    cache = BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_DIR else None
+    writer = None
+    rows = 0
+    try:
+        with AsyncBlobFetcher(max_in_flight=EXECUTOR_MAX_IN_FLIGHT, cache=cache, adaptive=FETCH_ADAPTIVE, max_blob_bytes=MAX_BLOB_BYTES) as fetcher:
+            for batch in batches:
+                enriched = enrich_record_batch(fetcher, batch)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_file, enriched.schema, compression='snappy')
+                writer.write_batch(enriched)
+                rows += batch.num_rows
+            write_dead_letters(dead_dir, partition_id, fetcher.take_failures())
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    if writer is not None:
+        writer.close()
+        os.replace(tmp_file, local_file)
+        if STREAM_UPLOADS:
+            # Upload from the task that wrote the file, while other tasks keep fetching. The
+            # driver cannot sweep an executor's disk, so a failed upload fails the partition
+            # (no marker) and it is redone instead
+            try:
+                upload_and_verify(local_file, f"{s3_prefix}/{partition_id}.parquet")
+            except Exception:
+                if os.path.exists(local_file):
+                    os.remove(local_file)
+                raise
+    mark_partition_done(marker_dir, partition_id, rows)
+    return rows
+
+def make_partition_writer(local_dir, marker_dir, dead_dir, s3_prefix, done):
+    # Every task enriches and writes its own partition file
+    def write_partition(batches):
+        partition_id = TaskContext.get().partitionId()
+        if partition_id in done:
+            return
+        rows = write_enriched_partition(batches, local_dir, marker_dir, partition_id, dead_dir, s3_prefix)
+        yield pa.RecordBatch.from_arrays(
+            [pa.array([partition_id], pa.int32()), pa.array([rows], pa.int64())],
+            names=['partition_id', 'rows']
+        )
+    return write_partition
+
+def process_row_group_units(file, spark, local_dir, marker_dir, dead_dir, s3_prefix):
+    # Work units come straight from the Parquet footer: no count, no shuffle, no Spark scan
+    metadata = read_footer(INPUT_BUCKET, file)
+    units = plan_row_group_units(metadata, ROWS_PER_UNIT)
+    done = completed_partitions(marker_dir)
+    pending = [unit for unit in units if unit['unit_id'] not in done]
+    print(f"Planned {len(units)} units of ~{ROWS_PER_UNIT} rows from {metadata.num_row_groups} row groups ({metadata.num_rows} rows), {len(pending)} pending")
+    if not pending:
+        return
+
+    def run_units(unit_iter):
+        for unit in unit_iter:
+            batches = iter_unit_batches(INPUT_BUCKET, file, unit['row_groups'])
+            yield unit['unit_id'], write_enriched_partition(batches, local_dir, marker_dir, unit['unit_id'], dead_dir, s3_prefix)
 
-def process_files(file, spark):
-    file_name = file.split('/')[-1]
-    print(f"Processing file: {file_name}")
+    try:
+        summary = spark.sparkContext.parallelize(pending, len(pending)).mapPartitions(run_units).collect()
+        print(f"Processed {len(summary)} units, {sum(rows for _, rows in summary)} rows in one job")
+    except Exception as e:
+        print("Error Occured", str(e))
+
+# Read the Parquet files from S3
 
-    df = spark.read.option("mergeSchema", "true").parquet(f's3a://llm-spark/{file}')
+def process_hash_partitions(file, spark, local_dir, marker_dir, dead_dir, s3_prefix):
+    df = spark.read.option("mergeSchema", "true").parquet(f's3a://{INPUT_BUCKET}/{file}')
     # df = spark.read.option("mergeSchema", "true").parquet(f'101.parquet')
     # df = df.repartition(120)  # Adjust number of partitions if needed
 
@@ -143,20 +484,37 @@ def process_files(file, spark):
     total_rows = df.count()
 
     # Define the chunk size
-    chunk_size = 800000  # Adjust this value as needed
+    chunk_size = ROWS_PER_UNIT
 
     # Repartition the DataFrame to have smaller chunks
     df = df.repartition(int(total_rows / chunk_size) + 1, 'blob_id')
-    s3_bucket = 'llm-spark'
-    s3_path = 'stack_v2/processed_data'
 
+    # Hash partitioning on blob_id is deterministic, so partition ids match between a
+    # crashed run and its rerun
+    num_partitions = df.rdd.getNumPartitions()
+    done = completed_partitions(marker_dir)
+    pending = [partition_id for partition_id in range(num_partitions) if partition_id not in done]
+    if done:
+        print(f"{len(done)} of {num_partitions} partitions already done, resuming at partition {pending[0] if pending else num_partitions}")
+
+    if PARTITION_MODE == 'single_pass':
+        pending = []
+        try:
+            summary = df.mapInArrow(make_partition_writer(local_dir, marker_dir, dead_dir, s3_prefix, done), partition_summary_schema).collect()
+            print(f"Processed {len(summary)} partitions, {sum(row['rows'] for row in summary)} rows in one job")
+        except Exception as e:
+            print("Error Occured", str(e))
+
+    # In loop mode each written partition directory is uploaded in the background while the
+    # next partition is processed; at most MAX_PENDING_UPLOADS partitions wait on local disk
+    upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    pending_uploads = []
 
-    local_dir = f"./extr1/{file_name.split('.')[0]}"
     # for start in tqdm(range(0, total_rows, chunk_size)):
-    for partition_id in range(df.rdd.getNumPartitions()):
+    for partition_id in pending:
         # partition_id = 13
         try:
-            print(f"Processing partition {partition_id + 1} of {df.rdd.getNumPartitions()}")
+            print(f"Processing partition {partition_id + 1} of {num_partitions}")
 
             # Extract the specific partition
             partition_df = df.rdd.mapPartitionsWithIndex(
@@ -164,45 +522,94 @@ def process_files(file, spark):
                 preservesPartitioning=True
             ).toDF()
 
-            data = partition_df.select('blob_id', 'src_encoding').collect()
-            # end = min(start + chunk_size, total_rows)
-            # chunk_df = df.limit(end).offset(start)  # Fetch the chunk of data
-            # data = chunk_df.select('blob_id', 'src_encoding').collect()
-
-            # Process the chunk and create a DataFrame
-            results = process_data_in_parallel(data)
-
-            
-            chunk_results_df = spark.createDataFrame(results, schema=extr_schema)
-            print("Result Count", chunk_results_df.count())
-            
-            # Append results to the main DataFrame
-            # results_df = results_df.union(chunk_results_df)
-            del results
-            # del chunk_results_df
+            enriched_schema = StructType(partition_df.schema.fields + extr_schema.fields[1:])
+            if FETCH_ENGINE == 'executor':
+                enriched_df = partition_df.mapInArrow(make_partition_enricher(dead_dir, partition_id), enriched_schema)
+            else:
+                # Persisting pins the row order, so the collected keys line up with the rows written below
+                partition_df = partition_df.persist()
+                # length_bytes lets the fetchers route by size and skip over-limit blobs without a GET
+                key_columns = ['blob_id', 'src_encoding'] + ([LENGTH_COLUMN] if LENGTH_COLUMN in partition_df.columns else [])
+                data = [row.asDict() for row in partition_df.select(*key_columns).collect()]
+                # end = min(start + chunk_size, total_rows)
+                # chunk_df = df.limit(end).offset(start)  # Fetch the chunk of data
+                # data = chunk_df.select('blob_id', 'src_encoding').collect()
+
+                # Process the chunk and create a DataFrame
+                dead_letters = []
+                if FETCH_ENGINE == 'async':
+                    results = process_data_async(data, dead_letters)
+                else:
+                    results = process_data_in_parallel(data, dead_letters)
+                write_dead_letters(dead_dir, partition_id, dead_letters)
+
+                results_broadcast = spark.sparkContext.broadcast(order_results(data, results))
+                print("Result Count", len(results))
+                del results, data
+                enriched_df = partition_df.mapInArrow(make_result_attacher(results_broadcast), enriched_schema)
+
             local_file = f"{local_dir}/{partition_id}.parquet"
             print("File is writing")
-            partition_df.join(chunk_results_df, on=['blob_id'], how='left')\
-                .write.mode('overwrite')\
-                    .parquet(local_file, compression="snappy")
-
+            enriched_df.write.mode('overwrite')\
+                .parquet(local_file, compression="snappy")
+            mark_partition_done(marker_dir, partition_id)
+            if STREAM_UPLOADS:
+                pending_uploads.append(upload_executor.submit(upload_tree, local_file, f"{s3_prefix}/{partition_id}.parquet", 4))
+                while len(pending_uploads) > MAX_PENDING_UPLOADS:
+                    pending_uploads.pop(0).result()
+
+            if FETCH_ENGINE != 'executor':
+                partition_df.unpersist()
+                results_broadcast.destroy()
             del partition_df
-            del chunk_results_df
+            del enriched_df
         except Exception as e:
             print("Error Occured", str(e))
 
+    upload_executor.shutdown(wait=True)
+
+
+def state_root():
+    return SCHEDULER_ROOT if SCHEDULER_ROOT.startswith('s3://') else os.path.abspath(SCHEDULER_ROOT)
+
+def file_dirs(file):
+    # Call on the driver and pass the result to tasks: relative paths would resolve against each
+    # executor's work directory. Markers and dead letters go to the shared SCHEDULER_ROOT
+    # (outside done/, which the scheduler lists), and each plan has its own ids.
+    stem = file.split('/')[-1].split('.')[0]
+    plan_name = f"rows{ROWS_PER_UNIT}" if PLAN_MODE == 'footer' else "hash"
+    local_root = os.path.abspath(LOCAL_ROOT)
+    return {
+        'local_dir': os.path.join(local_root, stem),
+        'marker_dir': f"{state_root()}/partitions/{stem}/{plan_name}/done",
+        'dead_dir': f"{state_root()}/partitions/{stem}/{plan_name}/dead",
+        'recovered_dir': os.path.join(local_root, '_recovered', stem),
+        's3_prefix': f"{OUTPUT_PREFIX}/{stem}",
+        'recovered_prefix': f"{RECOVERED_PREFIX}/{stem}",
+    }
+
+def finish_file(file):
+    dirs = file_dirs(file)
+    retry_dead_letters(dirs['dead_dir'], dirs['recovered_dir'])
+    # With STREAM_UPLOADS this only picks up files whose upload failed
+    if os.path.isdir(dirs['local_dir']):
+        print(f"Uploading directory {dirs['local_dir']} to s3://{OUTPUT_BUCKET}/{dirs['s3_prefix']}")
+        upload_tree(dirs['local_dir'], dirs['s3_prefix'])
+    if os.path.isdir(dirs['recovered_dir']):
+        print(f"Uploading recovered rows {dirs['recovered_dir']} to s3://{OUTPUT_BUCKET}/{dirs['recovered_prefix']}")
+        upload_tree(dirs['recovered_dir'], dirs['recovered_prefix'])
 
-    print(f"Uploading directory {local_dir} to s3://{s3_bucket}/{s3_path}/{file_name.split('.')[0]}")
-    s3_client = boto3.client('s3')
-    for root, dirs, files in os.walk(local_dir):
-        files_to_upload = [os.path.join(root, file) for file in files]
-        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as upload_executor:
-            futures = [upload_executor.submit(s3_client.upload_file, file, s3_bucket, f"{s3_path}/{file_name.split('.')[0]}/{os.path.relpath(file, local_dir)}") for file in files_to_upload]
-            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures), desc="Uploading files"):
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Error uploading file: {e}")
+def process_files(file, spark):
+    file_name = file.split('/')[-1]
+    print(f"Processing file: {file_name}")
+
+    dirs = file_dirs(file)
+    local_dir, marker_dir, dead_dir, s3_prefix = dirs['local_dir'], dirs['marker_dir'], dirs['dead_dir'], dirs['s3_prefix']
+    if PLAN_MODE == 'footer':
+        process_row_group_units(file, spark, local_dir, marker_dir, dead_dir, s3_prefix)
+    else:
+        process_hash_partitions(file, spark, local_dir, marker_dir, dead_dir, s3_prefix)
+    finish_file(file)
 
     # df = df.join(results_df, on=['blob_id'], how='inner')
 
@@ -212,6 +619,99 @@ def process_files(file, spark):
     # df.write.mode('overwrite').parquet(f'./extr1/{file_name}', compression="snappy")
 
 
+def plan_work(files):
+    # Footer mode: one unit per (file, row-group range), so a worker can take part of a file.
+    # Repartition mode needs a whole-file shuffle, so each file is a single unit.
+    def plan_file(file):
+        stem = file.split('/')[-1].split('.')[0]
+        if PLAN_MODE != 'footer':
+            return [{'key': f"{stem}.all", 'file': file, 'unit_id': None, 'row_groups': None, 'rows': None}]
+        units = plan_row_group_units(read_footer(INPUT_BUCKET, file), ROWS_PER_UNIT)
+        return [{'key': f"{stem}.{unit['unit_id']}", 'file': file, **unit} for unit in units]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PLAN_THREADS) as executor:
+        planned = list(tqdm(executor.map(plan_file, files), total=len(files), desc="Planning work units"))
+    return [unit for units in planned for unit in units]
+
+def run_claimed_units(units, spark):
+    # One Spark job for a batch of units that may span several files. Each unit reports its
+    # own (key, rows, error), so one bad unit does not fail the others in the job.
+    dirs_by_file = {unit['file']: file_dirs(unit['file']) for unit in units}
+
+    def run_units(unit_iter):
+        for unit in unit_iter:
+            dirs = dirs_by_file[unit['file']]
+            if unit['unit_id'] in completed_partitions(dirs['marker_dir']):
+                # Written by an earlier attempt that did not reach scheduler.complete
+                yield unit['key'], None, None
+                continue
+            try:
+                batches = iter_unit_batches(INPUT_BUCKET, unit['file'], unit['row_groups'])
+                rows = write_enriched_partition(batches, dirs['local_dir'], dirs['marker_dir'], unit['unit_id'], dirs['dead_dir'], dirs['s3_prefix'])
+                yield unit['key'], rows, None
+            except Exception as e:
+                yield unit['key'], None, f"{type(e).__name__}: {e}"
+
+    return spark.sparkContext.parallelize(units, len(units)).mapPartitions(run_units).collect()
+
+def run_scheduler(files, spark):
+    scheduler = WorkScheduler(open_lease_store(SCHEDULER_ROOT), WORKER_ID, LEASE_SECONDS)
+    units = scheduler.load_plan(lambda: plan_work(files))
+    print(f"Worker {WORKER_ID}: {len(units)} units in plan, {len(scheduler.remaining())} not done")
+    failed_attempts = {}
+    scheduler.start_heartbeat()
+    try:
+        while True:
+            # Claim enough units to keep every executor core busy; units that keep failing
+            # here are left to other workers
+            given_up = {key for key, attempts in failed_attempts.items() if attempts >= UNIT_MAX_ATTEMPTS}
+            claimed = scheduler.claim(spark.sparkContext.defaultParallelism, exclude=given_up)
+            if not claimed:
+                remaining = [unit for unit in scheduler.remaining() if unit['key'] not in given_up]
+                if not remaining:
+                    if given_up:
+                        print(f"Giving up on {len(given_up)} units after {UNIT_MAX_ATTEMPTS} attempts")
+                    break
+                # Everything left is leased by other workers; wait in case a lease expires
+                print(f"{len(remaining)} units leased by other workers, waiting")
+                time.sleep(LEASE_SECONDS / 6)
+                continue
+
+            print(f"Claimed {len(claimed)} units from {len({unit['file'] for unit in claimed})} files")
+            errors = {}
+            summary = {}
+            if PLAN_MODE == 'footer':
+                try:
+                    for key, rows, error in run_claimed_units(claimed, spark):
+                        if error is None:
+                            summary[key] = '' if rows is None else rows
+                        else:
+                            errors[key] = error
+                except Exception as e:
+                    # The job itself failed (e.g. an executor was lost); no unit reported back
+                    errors = {unit['key']: str(e) for unit in claimed}
+            else:
+                for unit in claimed:
+                    try:
+                        process_files(unit['file'], spark)
+                        summary[unit['key']] = ''
+                    except Exception as e:
+                        errors[unit['key']] = str(e)
+
+            for unit in claimed:
+                if unit['key'] in summary:
+                    scheduler.complete(unit['key'], summary[unit['key']])
+                else:
+                    # Units without a result (lost with a failed job) are released like failures
+                    print("Error Occured", unit['key'], errors.get(unit['key'], 'no result'))
+                    failed_attempts[unit['key']] = failed_attempts.get(unit['key'], 0) + 1
+                    scheduler.release(unit['key'])
+            if PLAN_MODE == 'footer':
+                for file in sorted({unit['file'] for unit in claimed if unit['key'] in summary}):
+                    finish_file(file)
+    finally:
+        scheduler.stop_heartbeat()
+
 def main():
     files = list_s3_files('llm-spark', 'Stack_V2')
     files = [file for file in files if 'Stack_V2-extr' not in file]
@@ -235,9 +735,14 @@ def main():
     .config("spark.driver.extraClassPath", "/opt/spark/jars/aws-java-sdk-bundle-1.12.375.jar:/opt/spark/jars/hadoop-aws-3.3.1.jar") \
     .config("spark.executor.extraClassPath", "/opt/spark/jars/aws-java-sdk-bundle-1.12.375.jar:/opt/spark/jars/hadoop-aws-3.3.1.jar") \
     .getOrCreate()
-    for file_x in files[270:360]:
-        print("file_name", file_x)
-        process_files(file_x, spark)
+    # Executors import the fetch engine when they run the partition enrichers
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    spark.sparkContext.addPyFile(os.path.join(script_dir, 'blob_fetch.py'))
+    spark.sparkContext.addPyFile(os.path.join(script_dir, 'blob_cache.py'))
+    spark.sparkContext.addPyFile(os.path.join(script_dir, 'blob_decode.py'))
+    spark.sparkContext.addPyFile(os.path.join(script_dir, 'work_units.py'))
+    # Start this on as many machines as needed; they share units through SCHEDULER_ROOT
+    run_scheduler(files, spark)
 
 if __name__ =='__main__':
     main()
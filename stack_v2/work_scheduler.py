@@ -0,0 +1,239 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+DEFAULT_LEASE_SECONDS = 3600
+PLAN_NAME = 'plan.json'
+
+
+class LocalLeaseStore:
+    """Lease files in a directory shared by all workers (local disk or a network mount).
+
+    Creation is atomic through os.link of a fully written temp file; replacing a lease
+    compares its current contents under an exclusive flock.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def create(self, name, body):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(body)
+        try:
+            os.link(tmp, path)
+            return body
+        except FileExistsError:
+            return None
+        finally:
+            os.remove(tmp)
+
+    def read(self, name):
+        try:
+            with open(self._path(name)) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                body = f.read()
+            return body, body
+        except FileNotFoundError:
+            return None
+
+    def replace(self, name, body, token):
+        try:
+            with open(self._path(name), 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if f.read() != token:
+                    return None
+                f.seek(0)
+                f.truncate()
+                f.write(body)
+            return body
+        except FileNotFoundError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        directory = self._path(prefix)
+        if not os.path.isdir(directory):
+            return set()
+        return {name for name in os.listdir(directory) if not name.endswith('.tmp')}
+
+
+class S3LeaseStore:
+    """Lease objects under an S3 prefix, using conditional writes (If-None-Match / If-Match)."""
+
+    def __init__(self, bucket, prefix, client=None):
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.client = client or boto3.client('s3')
+
+    def _key(self, name):
+        return f'{self.prefix}/{name}'
+
+    def _put(self, name, body, **conditions):
+        try:
+            return self.client.put_object(Bucket=self.bucket, Key=self._key(name), Body=body.encode(), **conditions)['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return None
+            raise
+
+    def create(self, name, body):
+        return self._put(name, body, IfNoneMatch='*')
+
+    def read(self, name):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return response['Body'].read().decode(), response['ETag']
+
+    def replace(self, name, body, token):
+        return self._put(name, body, IfMatch=token)
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(name))
+
+    def list(self, prefix):
+        names = set()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f'{self._key(prefix)}/'):
+            for obj in page.get('Contents', []):
+                names.add(obj['Key'].rsplit('/', 1)[-1])
+        return names
+
+
+def open_lease_store(root):
+    # 's3://bucket/prefix' uses S3 conditional writes, anything else is a (shared) directory
+    if root.startswith('s3://'):
+        bucket, _, prefix = root[len('s3://'):].partition('/')
+        return S3LeaseStore(bucket, prefix)
+    return LocalLeaseStore(root)
+
+
+class WorkScheduler:
+    """Hands out work units to any number of workers through a lease store.
+
+    The first worker to publish a plan fixes the unit list for everyone. A worker claims a
+    unit by creating leases/<unit_key>, keeps it alive with renew(), and finishes it by
+    writing done/<unit_key>. Leases that are not renewed expire and are taken over by
+    other workers, so units of a crashed worker are picked up again.
+    """
+
+    def __init__(self, store, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.store = store
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.units = []
+        self.held = {}
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def load_plan(self, build_units):
+        # build_units only runs when no plan has been published yet
+        existing = self.store.read(PLAN_NAME)
+        if existing is None:
+            self.store.create(PLAN_NAME, json.dumps(build_units()))
+            existing = self.store.read(PLAN_NAME)
+        self.units = json.loads(existing[0])
+        return self.units
+
+    def _lease_body(self):
+        return json.dumps({'owner': self.owner, 'expires': time.time() + self.lease_seconds})
+
+    def _try_claim(self, key):
+        name = f'leases/{key}'
+        token = self.store.create(name, self._lease_body())
+        if token is None:
+            current = self.store.read(name)
+            if current is None:
+                token = self.store.create(name, self._lease_body())
+            else:
+                body, current_token = current
+                lease = json.loads(body)
+                if lease['expires'] > time.time():
+                    return False
+                print(f"Taking over expired lease {key} from {lease['owner']}")
+                token = self.store.replace(name, self._lease_body(), current_token)
+        if token is None:
+            return False
+        if self.store.read(f'done/{key}') is not None:
+            # Finished after our listing of done/: complete() writes done/ before dropping the lease
+            self.store.delete(name)
+            return False
+        with self.lock:
+            self.held[key] = token
+        return True
+
+    def claim(self, limit, exclude=()):
+        done = self.store.list('done')
+        claimed = []
+        for unit in self.units:
+            if len(claimed) >= limit:
+                break
+            key = unit['key']
+            if key not in done and key not in self.held and key not in exclude and self._try_claim(key):
+                claimed.append(unit)
+        return claimed
+
+    def renew(self):
+        with self.lock:
+            held = dict(self.held)
+        for key, token in held.items():
+            new_token = self.store.replace(f'leases/{key}', self._lease_body(), token)
+            with self.lock:
+                if key not in self.held:
+                    continue
+                if new_token is None:
+                    print(f"Lost lease {key}")
+                    del self.held[key]
+                else:
+                    self.held[key] = new_token
+
+    def complete(self, key, summary=''):
+        self.store.create(f'done/{key}', str(summary))
+        with self.lock:
+            self.held.pop(key, None)
+        self.store.delete(f'leases/{key}')
+
+    def release(self, key):
+        with self.lock:
+            self.held.pop(key, None)
+        self.store.delete(f'leases/{key}')
+
+    def remaining(self):
+        done = self.store.list('done')
+        return [unit for unit in self.units if unit['key'] not in done]
+
+    def start_heartbeat(self):
+        def run():
+            while not self._stop.wait(self.lease_seconds / 3):
+                try:
+                    self.renew()
+                except Exception as e:
+                    print(f"Lease renewal failed: {e}")
+        self._heartbeat = threading.Thread(target=run, daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
@@ -0,0 +1,56 @@
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+DEFAULT_BATCH_SIZE = 10000
+
+_filesystems = {}
+
+
+def s3_filesystem(bucket):
+    # One filesystem per bucket and process, created in the bucket's own region
+    if bucket not in _filesystems:
+        _filesystems[bucket] = pafs.S3FileSystem(region=pafs.resolve_s3_region(bucket))
+    return _filesystems[bucket]
+
+
+def filesystem_for(uri):
+    # (filesystem, path) for 's3://bucket/prefix' or an absolute local (or shared-mount) directory
+    if uri.startswith('s3://'):
+        path = uri[len('s3://'):]
+        return s3_filesystem(path.split('/', 1)[0]), path
+    return pafs.LocalFileSystem(), uri
+
+
+def open_parquet(bucket, key):
+    return pq.ParquetFile(s3_filesystem(bucket).open_input_file(f'{bucket}/{key}'))
+
+
+def read_footer(bucket, key):
+    # Only the footer is fetched: row counts and row-group boundaries without scanning data
+    return open_parquet(bucket, key).metadata
+
+
+def plan_row_group_units(metadata, rows_per_unit):
+    """Groups consecutive row groups into work units of about rows_per_unit rows each.
+
+    A row group is never split, so a unit can exceed rows_per_unit when a single row
+    group is larger than that.
+    """
+    units = []
+    row_groups = []
+    rows = 0
+    for index in range(metadata.num_row_groups):
+        num_rows = metadata.row_group(index).num_rows
+        if row_groups and rows + num_rows > rows_per_unit:
+            units.append({'unit_id': len(units), 'row_groups': row_groups, 'rows': rows})
+            row_groups = []
+            rows = 0
+        row_groups.append(index)
+        rows += num_rows
+    if row_groups:
+        units.append({'unit_id': len(units), 'row_groups': row_groups, 'rows': rows})
+    return units
+
+
+def iter_unit_batches(bucket, key, row_groups, batch_size=DEFAULT_BATCH_SIZE):
+    return open_parquet(bucket, key).iter_batches(batch_size=batch_size, row_groups=row_groups)
@@ -0,0 +1,165 @@
+## Offline benchmark for the Stack v2 enrichment path in stack_v2_github.py.
+## Starts a local moto S3 server, seeds it with synthetic gzipped blobs and a matching
+## metadata shard, then runs enrich_file end to end. Needs moto[server] on top of the
+## usual requirements. Run from the repository root:
+##   python stack_v2_benchmark.py --rows 20000 --engine async --in-flight 500
+
+import os
+import time
+import gzip
+import socket
+import random
+import string
+import hashlib
+import argparse
+import tempfile
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+# Every boto3/aiobotocore client created from here on talks to the local server
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+from moto.server import ThreadedMotoServer
+
+BLOB_BUCKET = 'softwareheritage'
+BLOB_PREFIX = 'content/'
+
+def make_vocabulary(size=5000, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(size)]
+
+WORDS = make_vocabulary()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def blob_size(rng, median_bytes, max_bytes):
+    # Source files are roughly log-normal: many small files and a long tail of big ones
+    return int(min(max(rng.lognormvariate(0, 1.5) * median_bytes, 16), max_bytes))
+
+def synthetic_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+def seed_blobs(client, rows, seed, median_bytes, max_bytes, unique_fraction, large_fraction, large_bytes):
+    rng = random.Random(seed)
+    n_unique = max(1, int(rows * unique_fraction))
+    blobs = []
+    for i in range(n_unique):
+        # The log-normal tail almost never reaches the large lane, so a few blobs are sized into it
+        size = rng.randint(large_bytes, 2 * large_bytes) if rng.random() < large_fraction else blob_size(rng, median_bytes, max_bytes)
+        text = synthetic_text(rng, size).encode('utf-8')
+        blobs.append((hashlib.sha1(f'{seed}-{i}'.encode()).hexdigest(), gzip.compress(text), len(text)))
+
+    client.create_bucket(Bucket=BLOB_BUCKET)
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        list(executor.map(lambda blob: client.put_object(Bucket=BLOB_BUCKET, Key=f'{BLOB_PREFIX}{blob[0]}', Body=blob[1]), blobs))
+
+    # Shards repeat some blob_ids (vendored files, licenses), so rows may point at the same blob
+    blob_ids = [blobs[i][0] if i < n_unique else rng.choice(blobs)[0] for i in range(rows)]
+    compressed_sizes = {blob_id: len(data) for blob_id, data, _ in blobs}
+    # Uncompressed sizes, like the dataset's length_bytes column that drives size routing
+    lengths = {blob_id: length for blob_id, _, length in blobs}
+    return blob_ids, [lengths[blob_id] for blob_id in blob_ids], sum(compressed_sizes[blob_id] for blob_id in blob_ids)
+
+def write_metadata_shard(path, blob_ids, lengths, seed):
+    rng = random.Random(seed)
+    table = pa.table({
+        'blob_id': blob_ids,
+        'path': [f'src/file_{i}.py' for i in range(len(blob_ids))],
+        'language': [rng.choice(['Python', 'C', 'JavaScript', 'Go']) for _ in blob_ids],
+        'src_encoding': ['UTF-8'] * len(blob_ids),
+        'length_bytes': pa.array(lengths, pa.int64()),
+    })
+    pq.write_table(table, path)
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Stack v2 enrichment benchmark')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--engine', choices=['async', 'pool'], default='async')
+    parser.add_argument('--in-flight', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--median-bytes', type=int, default=4096)
+    parser.add_argument('--max-bytes', type=int, default=1024 * 1024)
+    parser.add_argument('--large-fraction', type=float, default=0.0005,
+                        help='share of unique blobs above LARGE_BLOB_BYTES, fetched through the ranged large-blob lane')
+    parser.add_argument('--unique-fraction', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help='enable the local blob cache')
+    args = parser.parse_args()
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+    server.start()
+    os.environ['AWS_ENDPOINT_URL'] = f'http://127.0.0.1:{port}'
+
+    try:
+        # Imported only now so its module-level clients pick up the local endpoint
+        import stack_v2_github
+        from blob_fetch import LARGE_BLOB_BYTES
+
+        client = boto3.client('s3')
+        blob_ids, lengths, compressed_bytes = seed_blobs(client, args.rows, args.seed, args.median_bytes, args.max_bytes, args.unique_fraction,
+                                                        args.large_fraction, LARGE_BLOB_BYTES)
+
+        work_dir = tempfile.mkdtemp(prefix='stack_v2_bench_')
+        shard_path = os.path.join(work_dir, 'bench.parquet')
+        write_metadata_shard(shard_path, blob_ids, lengths, args.seed)
+
+        stack_v2_github.FETCH_ENGINE = args.engine
+        stack_v2_github.FETCH_MAX_IN_FLIGHT = args.in_flight
+        stack_v2_github.FETCH_WORKERS = args.workers
+        stack_v2_github.BATCH_SIZE = args.batch_size
+        stack_v2_github.BLOB_CACHE_DIR = os.path.join(work_dir, 'cache') if args.cache else None
+        # Pool workers are forked after this is set, so both engines time every GET
+        stack_v2_github.FETCH_TRACK_LATENCY = True
+
+        engine = stack_v2_github.create_fetch_engine()
+        with engine:
+            start_time = time.monotonic()
+            ok = stack_v2_github.enrich_file(shard_path, 'bench/bench.parquet', engine)
+            elapsed = time.monotonic() - start_time
+            latencies = stack_v2_github.engine_latencies(engine)
+
+        if not ok:
+            raise SystemExit('Enrichment failed, see processing.log')
+
+        text_bytes = pc.sum(pc.binary_length(pq.read_table(shard_path, columns=['text'])['text'])).as_py()
+        print(f"engine={args.engine} rows={args.rows} in_flight={args.in_flight} workers={args.workers}")
+        print(f"elapsed        {elapsed:.2f} s")
+        print(f"rows/s         {args.rows / elapsed:.0f}")
+        print(f"MB/s (text)    {text_bytes / elapsed / 1e6:.2f}")
+        print(f"MB/s (gzipped) {compressed_bytes / elapsed / 1e6:.2f}")
+        print(f"large blobs    {sum(length >= LARGE_BLOB_BYTES for length in lengths)} rows at or above {LARGE_BLOB_BYTES // (1024 * 1024)} MiB")
+        if latencies:
+            print(f"fetch p50      {percentile(latencies, 0.5) * 1000:.1f} ms")
+            print(f"fetch p99      {percentile(latencies, 0.99) * 1000:.1f} ms")
+            print(f"fetch mean     {statistics.mean(latencies) * 1000:.1f} ms")
+        else:
+            print("fetch p50/p99  n/a (every blob came from the cache)")
+        print(f"peak RSS       {stack_v2_github.peak_rss_mb():.1f} MiB")
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
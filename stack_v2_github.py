@@ -1,16 +1,31 @@
 import os
+import sys
+import builtins
+import resource
 import boto3
+from botocore.config import Config
 import pyarrow as pa
 import pyarrow.parquet as pq
 import logging
 from tqdm import tqdm
-import pandas as pd
-import subprocess
 from smart_open import open
 from multiprocessing import Pool, cpu_count
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 import gc
+import time
+import base64
+import hashlib
+import math
+import threading
+import queue
+
+# The fetch engine modules live in stack_v2/ and import each other by plain module name,
+# the same way stack_v2/script.py and the Spark executors load them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stack_v2'))
+from blob_fetch import AsyncBlobFetcher, count_words, LENGTH_COLUMN
+from blob_cache import BlobCache
+from blob_decode import GzipBlobDecoder, BlobTooLargeError
 
 # Logging configuration
 log_file = 'processing.log'
@@ -21,85 +36,363 @@ bucket_name = 'llm-spark'
 input_prefix = 'Stack_V2/'
 local_temp_dir = '/tmp'
 output_prefix = "github_download/v2"
+MIB = 1024 * 1024
+BATCH_SIZE = 1000
+FETCH_ENGINE = 'async'  # 'async' for one process with many GETs in flight, 'pool' for the process pool
+FETCH_MAX_IN_FLIGHT = 1000  # Ceiling when FETCH_ADAPTIVE is on
+MAX_BLOB_BYTES = 64 * MIB  # Blobs inflating past this are skipped
+FETCH_ADAPTIVE = True  # Let the AIMD limiter pick in-flight GETs from latency and S3 throttling
+FETCH_WORKERS = cpu_count()
+FETCH_CHUNKSIZE = 50
+FETCH_TRACK_LATENCY = False  # Keep seconds per S3 GET for both engines (used by stack_v2_benchmark.py)
+FETCH_POOL_CONNECTIONS = 10
+DOWNLOAD_FILE_WORKERS = 4
+DOWNLOAD_CONNECTIONS = 16  # Concurrent ranged GETs per shard
+DOWNLOAD_PARTS_PER_CONNECTION = 4
+DOWNLOAD_MIN_PART_SIZE = 8 * MIB
+DOWNLOAD_MAX_PART_SIZE = 128 * MIB
+LOCAL_DISK_BUDGET = 200 * 1024 * MIB  # Bytes of local_temp_dir the pipeline may hold at once
+DISK_RESERVE_FACTOR = 4  # Reserved bytes per downloaded byte, covering the enriched output too
+PIPELINE_QUEUE_SIZE = 2
+ENRICH_WORKERS = 1  # Each enrich worker owns a fetch engine; keep at 1 with FETCH_ENGINE = 'pool'
+UPLOAD_WORKERS = 2
+UPLOAD_PART_SIZE = 64 * MIB
+UPLOAD_PART_CONCURRENCY = 10  # Parts in flight per uploaded file
+BLOB_CACHE_DIR = '/tmp/swh_blob_cache'  # Set to None to disable the local blob cache
+BLOB_CACHE_MAX_BYTES = 50 * 1024 * MIB
+DEAD_LETTER_DIR = 'dead_letters'  # Rows the async engine failed or skipped, one Parquet file per shard
+PROCESSED_LEDGER = 'processed_ledger.txt'  # Output keys already in S3, one per line
+PROCESSED_LEDGER_CURSOR = 'processed_ledger.cursor'  # Last key seen by the incremental listing
+
+fetch_client = None
+ledger_lock = threading.Lock()
+blob_cache = None
+fetch_latencies = None  # Per-GET seconds: per worker in pool workers, gathered in the parent by fetch_texts
+blob_decoder = GzipBlobDecoder(max_bytes=MAX_BLOB_BYTES)
+download_client = boto3.client('s3', config=Config(max_pool_connections=DOWNLOAD_FILE_WORKERS * DOWNLOAD_CONNECTIONS))
+upload_client = boto3.client('s3', config=Config(max_pool_connections=UPLOAD_WORKERS * UPLOAD_PART_CONCURRENCY))
+
+def upload_part(fd, bucket_name, s3_key, upload_id, part_number, offset, length):
+    data = os.pread(fd, length, offset)
+    digest = hashlib.md5(data).digest()
+    response = upload_client.upload_part(
+        Bucket=bucket_name, Key=s3_key, UploadId=upload_id, PartNumber=part_number,
+        Body=data, ContentMD5=base64.b64encode(digest).decode()
+    )
+    if response['ETag'].strip('"') != digest.hex():
+        raise IOError(f"Checksum mismatch on part {part_number} of {s3_key}")
+    return {'PartNumber': part_number, 'ETag': response['ETag']}, digest
+
+def multipart_upload(file_path, bucket_name, s3_key):
+    file_size = os.path.getsize(file_path)
+    # S3 allows at most 10000 parts, so very large files get bigger parts
+    part_size = max(UPLOAD_PART_SIZE, math.ceil(file_size / 10000 / MIB) * MIB)
+    offsets = list(range(0, file_size, part_size)) or [0]
+
+    upload_id = upload_client.create_multipart_upload(Bucket=bucket_name, Key=s3_key)['UploadId']
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_PART_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(upload_part, fd, bucket_name, s3_key, upload_id, index + 1, offset, min(part_size, file_size - offset))
+                for index, offset in enumerate(offsets)
+            ]
+            results = [future.result() for future in futures]
+
+        parts = [part for part, _ in results]
+        response = upload_client.complete_multipart_upload(
+            Bucket=bucket_name, Key=s3_key, UploadId=upload_id, MultipartUpload={'Parts': parts}
+        )
+    except Exception:
+        upload_client.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+        raise
+    finally:
+        os.close(fd)
+
+    # The multipart ETag is the MD5 of the concatenated part MD5s, which confirms the whole object
+    expected_etag = f'{hashlib.md5(b"".join(digest for _, digest in results)).hexdigest()}-{len(parts)}'
+    if response['ETag'].strip('"') != expected_etag:
+        raise IOError(f"Checksum mismatch on {s3_key}: expected {expected_etag}, got {response['ETag']}")
+    return file_size
 
 def upload_to_s3(file_path, bucket_name, s3_key):
     try:
         s3_dest = f's3://{bucket_name}/{s3_key}'
-        subprocess.run(['aws', 's3', 'cp', file_path, s3_dest], check=True)
-        logging.info(f"Uploaded {file_path} to {s3_dest}")
+        start_time = time.monotonic()
+        file_size = multipart_upload(file_path, bucket_name, s3_key)
+        elapsed = max(time.monotonic() - start_time, 1e-6)
+        logging.info(f"Uploaded {file_path} to {s3_dest} ({file_size} bytes in {elapsed:.1f}s, {file_size / elapsed / MIB:.1f} MiB/s)")
         os.remove(file_path)
         logging.info(f"Deleted local file {file_path}")
-    except subprocess.CalledProcessError as e:
+        return True
+    except Exception as e:
         logging.error(f"Failed to upload {file_path} to S3: {e}")
+        return False
+
+def create_blob_cache():
+    return BlobCache(BLOB_CACHE_DIR, BLOB_CACHE_MAX_BYTES) if BLOB_CACHE_DIR else None
+
+def init_fetch_worker():
+    # One warm client per worker process, reused for every blob it fetches during the run
+    global fetch_client, blob_cache, fetch_latencies
+    fetch_client = boto3.client('s3', config=Config(max_pool_connections=FETCH_POOL_CONNECTIONS))
+    blob_cache = create_blob_cache()
+    fetch_latencies = [] if FETCH_TRACK_LATENCY else None
+
+def download_compressed(blob_id):
+    if blob_cache is not None:
+        compressed_data = blob_cache.get(blob_id)
+        if compressed_data is not None:
+            return compressed_data
 
-def download_contents(blob_id, src_encoding):
     s3_url = f"s3://softwareheritage/content/{blob_id}"
+    transport_params = {'client': fetch_client} if fetch_client is not None else None
+    start_time = time.monotonic()
+    # Read the gzipped bytes as stored so the cache holds them compressed
+    with open(s3_url, "rb", compression="disable", transport_params=transport_params) as fin:
+        compressed_data = fin.read()
+    if fetch_latencies is not None:
+        # Cache hits are not GETs, same as in AsyncBlobFetcher
+        fetch_latencies.append(time.monotonic() - start_time)
+    if blob_cache is not None:
+        try:
+            blob_cache.put(blob_id, compressed_data)
+        except Exception as e:
+            # The GET succeeded; a cache that cannot take the blob must not fail the row
+            logging.warning(f"Could not cache blob_id {blob_id}: {e}")
+    return compressed_data
+
+def download_text(blob_id, src_encoding):
     try:
-        with open(s3_url, "rb", compression=".gz") as fin:
-            content = fin.read().decode(src_encoding)
-        return {"text": content, "word_count": len(content.split())}
+        return blob_decoder.decode([download_compressed(blob_id)], src_encoding)
+    except BlobTooLargeError as e:
+        logging.warning(f"Skipping blob_id {blob_id}: {e}")
+        return ""
     except Exception as e:
         logging.error(f"Error downloading blob_id {blob_id}: {e}")
-        return {"text": "", "word_count": 0}
+        return ""
+
+def download_contents(blob_id, src_encoding):
+    content = download_text(blob_id, src_encoding)
+    return {"text": content, "word_count": len(content.split())}
+
+def fetch_blob(key):
+    blob_id, src_encoding, length = key
+    if length is not None and length > MAX_BLOB_BYTES:
+        logging.warning(f"Skipping blob_id {blob_id}: length_bytes {length} exceeds {MAX_BLOB_BYTES} bytes")
+        return ""
+    return download_text(blob_id, src_encoding)
 
-def process_row(row):
-    content_data = download_contents(row["blob_id"], row["src_encoding"])
-    row.update(content_data)
-    return row
+def fetch_blob_timed(key):
+    # Hands the worker's GET latencies back with the text so the parent can collect them
+    text = fetch_blob(key)
+    latencies = fetch_latencies[:]
+    fetch_latencies.clear()
+    return text, latencies
 
-def process_file(local_file_path, s3_key):
+def create_fetch_engine():
+    global fetch_latencies
+    if FETCH_ENGINE == 'async':
+        return AsyncBlobFetcher(max_in_flight=FETCH_MAX_IN_FLIGHT, cache=create_blob_cache(), track_latency=FETCH_TRACK_LATENCY,
+                                adaptive=FETCH_ADAPTIVE, max_blob_bytes=MAX_BLOB_BYTES)
+    fetch_latencies = [] if FETCH_TRACK_LATENCY else None
+    return Pool(FETCH_WORKERS, initializer=init_fetch_worker)
+
+def engine_latencies(engine):
+    # Seconds per S3 GET so far, or None when FETCH_TRACK_LATENCY is off
+    return engine.latencies if isinstance(engine, AsyncBlobFetcher) else fetch_latencies
+
+def fetch_texts(engine, keys, desc):
+    if isinstance(engine, AsyncBlobFetcher):
+        return engine.fetch_all(keys, count_words=False)
+    if fetch_latencies is None:
+        return list(tqdm(engine.imap(fetch_blob, keys, chunksize=FETCH_CHUNKSIZE), desc=desc, total=len(keys), unit="row"))
+    texts = []
+    for text, latencies in tqdm(engine.imap(fetch_blob_timed, keys, chunksize=FETCH_CHUNKSIZE), desc=desc, total=len(keys), unit="row"):
+        texts.append(text)
+        fetch_latencies.extend(latencies)
+    return texts
+
+def enrich_batch(engine, batch, desc):
+    # Columnar enrichment: the batch is never converted to pandas or row dicts
+    blob_ids = batch.column('blob_id').to_pylist()
+    src_encodings = batch.column('src_encoding').to_pylist()
+    # The async engine routes by length_bytes (ranged GETs for large blobs); both engines skip over-limit ones
+    lengths = batch.column(LENGTH_COLUMN).to_pylist() if batch.schema.get_field_index(LENGTH_COLUMN) >= 0 else [None] * batch.num_rows
+    text = pa.array(fetch_texts(engine, list(zip(blob_ids, src_encodings, lengths)), desc), pa.string())
+    word_count = count_words(text).cast(pa.int64())
+    return batch.append_column('text', text).append_column('word_count', word_count)
+
+def reset_peak_rss():
+    # Writing "5" to clear_refs resets VmHWM so the next reading is per shard (Linux only)
     try:
+        with builtins.open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with builtins.open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def output_schema(parquet_file):
+    schema = parquet_file.schema_arrow
+    return schema.append(pa.field('text', pa.string())).append(pa.field('word_count', pa.int64()))
+
+def write_dead_letters(s3_key, failures):
+    # Drained once per shard so the long-lived fetcher does not keep every failure of the run
+    if not failures:
+        return
+    os.makedirs(DEAD_LETTER_DIR, exist_ok=True)
+    dead_path = os.path.join(DEAD_LETTER_DIR, f"{os.path.basename(s3_key).split('.')[0]}.parquet")
+    pq.write_table(pa.Table.from_pylist(failures), dead_path, compression='snappy')
+    logging.warning(f"{len(failures)} rows of {s3_key} were not fetched, written to {dead_path}")
+
+def enrich_file(local_file_path, s3_key, engine):
+    try:
+        reset_peak_rss()
         parquet_file = pq.ParquetFile(local_file_path)
-        updated_rows = []
-        
-        for batch in tqdm(parquet_file.iter_batches(batch_size=1000), desc=f"Processing {s3_key}", unit="batch"):
-            df = batch.to_pandas()
-            rows = df.to_dict('records')
-            
-            with Pool(cpu_count()) as pool:
-                processed_rows = list(tqdm(pool.imap(process_row, rows), desc=f"Processing rows in {s3_key}", total=len(rows), unit="row"))
-            
-            updated_rows.extend(processed_rows)
-        
-        updated_table = pa.Table.from_pandas(pd.DataFrame(updated_rows))
-        pq.write_table(updated_table, local_file_path, compression='snappy')
-        
-        if os.path.exists(local_file_path):
-            logging.info(f"Output file {local_file_path} exists, proceeding to upload.")
-            s3_output_key = f'{output_prefix}/{os.path.basename(s3_key)}'
-            upload_to_s3(local_file_path, bucket_name, s3_output_key)
-        else:
-            logging.error(f"Output file {local_file_path} does not exist, skipping upload.")
-        
-        del updated_rows, updated_table, parquet_file
+        schema = output_schema(parquet_file)
+        tmp_output_path = f'{local_file_path}.part'
+
+        # Each enriched batch is written as its own row group, so memory stays at about one batch
+        with pq.ParquetWriter(tmp_output_path, schema, compression='snappy') as writer:
+            for batch in tqdm(parquet_file.iter_batches(batch_size=BATCH_SIZE), desc=f"Processing {s3_key}", unit="batch"):
+                # Only (blob_id, src_encoding) goes to the fetchers and only text comes back
+                writer.write_batch(enrich_batch(engine, batch, desc=f"Processing rows in {s3_key}"))
+
+        del parquet_file
+        os.replace(tmp_output_path, local_file_path)
+        if isinstance(engine, AsyncBlobFetcher):
+            write_dead_letters(s3_key, engine.take_failures())
+        logging.info(f"Peak RSS while processing {s3_key}: {peak_rss_mb():.1f} MiB")
+        if isinstance(engine, AsyncBlobFetcher) and engine.limiter is not None:
+            logging.info(f"Fetch concurrency after {s3_key}: {engine.limiter.stats()}")
+        if isinstance(engine, AsyncBlobFetcher) and engine.cache is not None:
+            # The fetcher's own cache instance: hit rate of this run, no extra connection
+            cache_stats = engine.cache.stats()
+            logging.info(f"Blob cache this run: {cache_stats['hit_rate']:.1%} hit rate ({cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['total_bytes']} bytes cached)")
         gc.collect()
-        
+        return True
+
     except Exception as e:
         logging.error(f"Failed to process {s3_key}: {e}")
+        if isinstance(engine, AsyncBlobFetcher):
+            # The shard is redone as a whole, so its partial failures are dropped
+            engine.take_failures()
+        return False
 
-def resumable_download(bucket, key, local_path):
-    if os.path.exists(local_path):
-        existing_size = os.path.getsize(local_path)
+def upload_output(local_file_path, s3_key):
+    if os.path.exists(local_file_path):
+        logging.info(f"Output file {local_file_path} exists, proceeding to upload.")
+        s3_output_key = f'{output_prefix}/{os.path.basename(s3_key)}'
+        if upload_to_s3(local_file_path, bucket_name, s3_output_key):
+            record_processed([s3_output_key])
     else:
-        existing_size = 0
-    
+        logging.error(f"Output file {local_file_path} does not exist, skipping upload.")
+
+def process_file(local_file_path, s3_key, engine=None):
+    if engine is None:
+        with create_fetch_engine() as engine:
+            return process_file(local_file_path, s3_key, engine)
+
+    if enrich_file(local_file_path, s3_key, engine):
+        upload_output(local_file_path, s3_key)
+
+def choose_part_size(total_size, connections):
+    # Aim for a few parts per connection so a slow part does not stall the tail of the download
+    part_size = math.ceil(total_size / (connections * DOWNLOAD_PARTS_PER_CONNECTION))
+    part_size = math.ceil(part_size / MIB) * MIB
+    return min(max(part_size, DOWNLOAD_MIN_PART_SIZE), DOWNLOAD_MAX_PART_SIZE)
+
+def load_manifest(manifest_path, etag, total_size):
+    try:
+        with builtins.open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('etag') != etag or manifest.get('size') != total_size:
+        return None
+    return manifest
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = f'{manifest_path}.tmp'
+    with builtins.open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def download_part(bucket, key, etag, fd, start, end, progress):
+    response = download_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag)
+    offset = start
+    for chunk in response['Body'].iter_chunks(MIB):
+        os.pwrite(fd, chunk, offset)
+        offset += len(chunk)
+        progress.update(len(chunk))
+    if offset != end + 1:
+        raise IOError(f"Short read for bytes {start}-{end} of {key}: got {offset - start} bytes")
+
+def resumable_download(bucket, key, local_path, connections=None):
+    connections = connections or DOWNLOAD_CONNECTIONS
+    manifest_path = f'{local_path}.parts.json'
+
     response = s3_client.head_object(Bucket=bucket, Key=key)
     total_size = response['ContentLength']
-    
-    if existing_size == total_size:
-        logging.info(f"{local_path} is already fully downloaded.")
-        return
-    
-    with open(local_path, 'ab') as f:
-        for start in tqdm(range(existing_size, total_size, 1024 * 1024), desc=f"Downloading {key}", unit='B', unit_scale=True, unit_divisor=1024):
-            end = min(start + 1024 * 1024 - 1, total_size - 1)
-            response = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}')
-            f.write(response['Body'].read())
-            logging.info(f"Downloaded bytes {start}-{end} of {key}")
-
-def list_s3_files(bucket_name, prefix):
+    etag = response['ETag']
+
+    manifest = load_manifest(manifest_path, etag, total_size)
+    if manifest is not None and not (os.path.exists(local_path) and os.path.getsize(local_path) == total_size):
+        # The manifest's finished parts are only real if the preallocated file is still there
+        logging.info(f"Ignoring {manifest_path}: {local_path} is missing or has the wrong size.")
+        manifest = None
+    if manifest is None:
+        # The manifest is written before the file is preallocated and removed only after the last
+        # part, so a full-size file without one is complete; with any manifest left it is not
+        if os.path.exists(manifest_path):
+            remove_files(local_path)
+        elif os.path.exists(local_path) and os.path.getsize(local_path) == total_size:
+            logging.info(f"{local_path} is already fully downloaded.")
+            return
+        manifest = {'etag': etag, 'size': total_size, 'part_size': choose_part_size(total_size, connections), 'done': []}
+
+    part_size = manifest['part_size']
+    parts = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+    done = set(manifest['done'])
+    pending = [index for index in range(len(parts)) if index not in done]
+    manifest_lock = threading.Lock()
+
+    save_manifest(manifest_path, manifest)
+    fd = os.open(local_path, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, total_size)
+        completed_bytes = sum(parts[index][1] - parts[index][0] + 1 for index in done)
+        with tqdm(total=total_size, initial=completed_bytes, desc=f"Downloading {key}", unit='B', unit_scale=True, unit_divisor=1024) as progress:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                futures = {executor.submit(download_part, bucket, key, etag, fd, *parts[index], progress): index for index in pending}
+                for future in as_completed(futures):
+                    future.result()
+                    # A part is only recorded once its bytes are on disk, so resume is exact
+                    os.fsync(fd)
+                    with manifest_lock:
+                        manifest['done'].append(futures[future])
+                        save_manifest(manifest_path, manifest)
+    finally:
+        os.close(fd)
+
+    os.remove(manifest_path)
+    logging.info(f"Downloaded {key} ({total_size} bytes, {len(parts)} parts of {part_size} bytes) to {local_path}")
+
+def list_s3_files(bucket_name, prefix, start_after=None):
     paginator = s3_client.get_paginator('list_objects_v2')
-    page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+    if start_after:
+        page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix, StartAfter=start_after)
+    else:
+        page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
     
     file_keys = []
     for page in page_iterator:
@@ -109,18 +402,43 @@ def list_s3_files(bucket_name, prefix):
                     file_keys.append(obj['Key'])
     return file_keys
 
-def download_files(file_keys):
-    with ThreadPoolExecutor(max_workers=cpu_count()) as executor:
-        futures = []
-        for s3_key in file_keys:
-            local_file_path = f'{local_temp_dir}/{os.path.basename(s3_key)}'
-            futures.append(executor.submit(resumable_download, bucket_name, s3_key, local_file_path))
-        
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading files"):
-            future.result()
+def load_processed_ledger():
+    processed_keys = set()
+    if os.path.exists(PROCESSED_LEDGER):
+        with builtins.open(PROCESSED_LEDGER) as f:
+            processed_keys = set(line.strip() for line in f if line.strip())
+    cursor = None
+    if os.path.exists(PROCESSED_LEDGER_CURSOR):
+        with builtins.open(PROCESSED_LEDGER_CURSOR) as f:
+            cursor = f.read().strip() or None
+    return processed_keys, cursor
+
+def record_processed(s3_output_keys):
+    with ledger_lock, builtins.open(PROCESSED_LEDGER, 'a') as f:
+        for s3_output_key in s3_output_keys:
+            f.write(f'{s3_output_key}\n')
+
+def sync_processed_ledger():
+    # Only keys after the last listed one are fetched, so startup cost follows new output.
+    # Keys that sort before the cursor (e.g. written by another machine) need a full
+    # resync, which happens when the cursor file is deleted.
+    processed_keys, cursor = load_processed_ledger()
+    listed_keys = list_s3_files(bucket_name, output_prefix, start_after=cursor)
+    new_keys = [key for key in listed_keys if key not in processed_keys]
+    if new_keys:
+        record_processed(new_keys)
+        processed_keys.update(new_keys)
+    if listed_keys:
+        cursor = max(listed_keys)
+        tmp_path = f'{PROCESSED_LEDGER_CURSOR}.tmp'
+        with builtins.open(tmp_path, 'w') as f:
+            f.write(cursor)
+        os.replace(tmp_path, PROCESSED_LEDGER_CURSOR)
+    logging.info(f"Processed ledger synced: {len(new_keys)} new, {len(processed_keys)} total.")
+    return processed_keys
 
 def list_processed_files():
-    return list_s3_files(bucket_name, output_prefix)
+    return sorted(sync_processed_ledger())
 
 def process_files_from_json(json_file_path):
     with open(json_file_path, 'r') as json_file:
@@ -136,14 +454,114 @@ def process_files_from_json(json_file_path):
     # Log the number of files to be processed
     logging.info(f"{len(file_keys_to_process)} out of {len(file_keys)} files to process.")
     
-    # Download files concurrently
-    download_files(file_keys_to_process)
-    
-    # Process files sequentially to limit memory usage
-    for s3_key in tqdm(file_keys_to_process, desc="Processing files from JSON"):
+    run_pipeline(file_keys_to_process)
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class DiskBudget:
+    # Blocks downloads until enough of the local disk budget has been freed by finished uploads
+    def __init__(self, limit_bytes):
+        self.limit_bytes = limit_bytes
+        self.used_bytes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self.condition:
+            # A shard bigger than the whole budget still runs, but only on an otherwise empty disk
+            self.condition.wait_for(lambda: self.used_bytes == 0 or self.used_bytes + nbytes <= self.limit_bytes)
+            self.used_bytes += nbytes
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used_bytes -= nbytes
+            self.condition.notify_all()
+
+def run_pipeline(file_keys):
+    # download -> enrich -> upload with bounded queues, so the slowest stage sets the pace
+    budget = DiskBudget(LOCAL_DISK_BUDGET)
+    to_enrich = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    to_upload = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    def download_stage(s3_key):
         local_file_path = f'{local_temp_dir}/{os.path.basename(s3_key)}'
-        process_file(local_file_path, s3_key)
-        gc.collect()  # Collect garbage after processing each file to free up memory
+        # Reserve room for the input shard plus its enriched output, which carries the blob text
+        reserved = s3_client.head_object(Bucket=bucket_name, Key=s3_key)['ContentLength'] * DISK_RESERVE_FACTOR
+        budget.acquire(reserved)
+        try:
+            resumable_download(bucket_name, s3_key, local_file_path)
+        except Exception as e:
+            logging.error(f"Failed to download {s3_key}: {e}")
+            # Budget only covers files on disk, so the partial download goes with it
+            remove_files(local_file_path, f'{local_file_path}.parts.json', f'{local_file_path}.parts.json.tmp')
+            budget.release(reserved)
+            return
+        to_enrich.put((s3_key, local_file_path, reserved))
+
+    # Stage threads never die on an item's error: a dead consumer would leave the producers
+    # blocked on a full queue and the run would hang without a message
+    def discard(item):
+        s3_key, local_file_path, reserved = item
+        remove_files(local_file_path, f'{local_file_path}.part')
+        budget.release(reserved)
+
+    def enrich_stage():
+        try:
+            engine = create_fetch_engine()
+        except Exception as e:
+            logging.error(f"Failed to create the fetch engine: {e}")
+            # Keep consuming so downloads finish; their shards are redone on the next run
+            for item in iter(to_enrich.get, None):
+                logging.error(f"Skipping {item[0]}: no fetch engine")
+                discard(item)
+            return
+        with engine:
+            for item in iter(to_enrich.get, None):
+                try:
+                    if enrich_file(item[1], item[0], engine):
+                        to_upload.put(item)
+                        continue
+                except Exception as e:
+                    logging.error(f"Enrich stage failed for {item[0]}: {e}")
+                discard(item)
+
+    def upload_stage():
+        for item in iter(to_upload.get, None):
+            s3_key, local_file_path, reserved = item
+            try:
+                upload_output(local_file_path, s3_key)
+            except Exception as e:
+                logging.error(f"Upload stage failed for {s3_key}: {e}")
+            finally:
+                # upload_to_s3 deletes the file once uploaded; a failed upload is redone from scratch
+                remove_files(local_file_path)
+                budget.release(reserved)
+
+    enrich_threads = [threading.Thread(target=enrich_stage, daemon=True) for _ in range(ENRICH_WORKERS)]
+    upload_threads = [threading.Thread(target=upload_stage, daemon=True) for _ in range(UPLOAD_WORKERS)]
+    for thread in enrich_threads + upload_threads:
+        thread.start()
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_FILE_WORKERS) as executor:
+        futures = [executor.submit(download_stage, s3_key) for s3_key in file_keys]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading files"):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Download stage failed: {e}")
+
+    for _ in enrich_threads:
+        to_enrich.put(None)
+    for thread in enrich_threads:
+        thread.join()
+    for _ in upload_threads:
+        to_upload.put(None)
+    for thread in upload_threads:
+        thread.join()
 
 if __name__ == "__main__":
     json_file_path = 'batch1.json'  # Update this with the path to your JSON file